@@ -0,0 +1,242 @@
+from codec import encode, decode, Codec, train
+from engine import Engine
+from store import Store, StoreServer, StoreHandler
+from message import Get, Insert, Select, Shutdown, frame
+from wal import WALEngine
+from threading import Thread
+import shard
+import argparse
+import contextlib
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import re
+import string
+import tempfile
+import time
+
+
+def document(rng: random.Random, depth: int = 2) -> dict:
+    doc = {
+        "id": rng.randrange(1 << 32),
+        "name": "".join(rng.choices(string.ascii_letters, k=12)),
+        "active": rng.random() < 0.5,
+        "score": rng.random(),
+        "tags": [rng.choice(["red", "green", "blue"]) for _ in range(3)],
+    }
+    if depth > 0:
+        doc["children"] = [document(rng, depth - 1) for _ in range(2)]
+    return doc
+
+
+def timed(f, n: int) -> float:
+    start = time.perf_counter()
+    for _ in range(n):
+        f()
+    return time.perf_counter() - start
+
+
+def bench_codec(args: argparse.Namespace) -> None:
+    rng = random.Random(0)
+    docs = [document(rng) for _ in range(args.n)]
+
+    zlib = Codec(args.compress_threshold)
+    trained = Codec(args.compress_threshold, zdict=train(docs[: args.n // 10]))
+    formats = {
+        "json": (lambda v: json.dumps(v).encode(), json.loads),
+        "codec": (encode, decode),
+        "typed": (lambda v: encode(v, typed=True), decode),
+        "zlib": (zlib.encode, zlib.decode),
+        "zdict": (trained.encode, trained.decode),
+    }
+    for name, (dumps, loads) in formats.items():
+        encoded = [dumps(d) for d in docs]
+        write = timed(lambda: [dumps(d) for d in docs], args.rounds)
+        parse = timed(lambda: [loads(e) for e in encoded], args.rounds)
+        size = sum(len(e) for e in encoded)
+        total = args.n * args.rounds
+        print(
+            f"{name:>8}: encode {1e6 * write / total:.2f}us/value, "
+            f"decode {1e6 * parse / total:.2f}us/value, {size / args.n:.0f} bytes/value"
+        )
+
+
+# Keeps everything in memory so only the store's own work is measured.
+class MemoryEngine(Engine):
+    def __init__(self, items: dict) -> None:
+        self.items = items
+
+    def load(self) -> dict:
+        return dict(self.items)
+
+    def save(self, items: dict) -> None:
+        pass
+
+
+def bench_select(args: argparse.Namespace) -> None:
+    # keys look like user:000042:2, every extra leading zero in the pattern
+    # narrows the matching range tenfold
+    width = len(str(args.n - 1))
+    items = {f"user:{i:0{width}d}:{i % 10}": {"id": i} for i in range(args.n)}
+    store = Store("bench", MemoryEngine(items))
+
+    for digits in range(width - 3, width + 1):
+        pattern = f"user:{'0' * digits}.*:7"
+        regex = re.compile(pattern)
+        scan = timed(lambda: [k for k in items if regex.match(k)], args.rounds)
+        indexed = timed(lambda: store.select(pattern), args.rounds)
+        matches = len(store.select(pattern))
+        print(
+            f"{pattern:>24}: {matches:>6} matches, full scan {1000 * scan / args.rounds:.2f}ms, "
+            f"prefix {1000 * indexed / args.rounds:.2f}ms"
+        )
+
+
+class QuietHandler(StoreHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def bench_keepalive(args: argparse.Namespace) -> None:
+    items = {f"k{i}": {"id": i} for i in range(1000)}
+    server = StoreServer(("localhost", 0), QuietHandler, Store("bench", MemoryEngine(items)))
+    Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+    payloads = [Get(k=f"k{i % 1000}").serialize() for i in range(args.n)]
+
+    # a fresh connection per request, as before keep-alive
+    def close() -> None:
+        for payload in payloads:
+            conn = http.client.HTTPConnection(host, port)
+            conn.request("POST", "/", payload, {"Connection": "close"})
+            conn.getresponse().read()
+            conn.close()
+
+    def keep_alive() -> None:
+        conn = http.client.HTTPConnection(host, port)
+        for payload in payloads:
+            conn.request("POST", "/", payload)
+            conn.getresponse().read()
+        conn.close()
+
+    # the handler reports every request on stdout
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        results = {name: timed(f, args.rounds) for name, f in [("close", close), ("keep-alive", keep_alive)]}
+    for name, seconds in results.items():
+        print(f"{name:>10}: {args.n * args.rounds / seconds:.0f} requests/s")
+    server.shutdown()
+    server.server_close()
+
+
+def bench_pipeline(args: argparse.Namespace) -> None:
+    with tempfile.TemporaryDirectory() as d:
+        store = Store(d, WALEngine(d, fsync=args.fsync))
+        server = StoreServer(("localhost", 0), QuietHandler, store)
+        Thread(target=server.serve_forever, daemon=True).start()
+        conn = http.client.HTTPConnection(*server.server_address)
+        msgs = [Insert(k=f"k{i}", v={"id": i}) for i in range(args.n)]
+
+        # every insert is saved on its own
+        def one_by_one() -> None:
+            for msg in msgs:
+                conn.request("POST", "/", msg.serialize())
+                conn.getresponse().read()
+
+        def pipelined() -> None:
+            for i in range(0, args.n, args.batch):
+                conn.request("POST", "/pipeline", b"".join(frame(msg) for msg in msgs[i : i + args.batch]))
+                conn.getresponse().read()
+
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            results = {
+                "one by one": timed(one_by_one, args.rounds),
+                f"batch {args.batch}": timed(pipelined, args.rounds),
+            }
+        for name, seconds in results.items():
+            print(f"{name:>10}: {args.n * args.rounds / seconds:.0f} inserts/s")
+        conn.close()
+        server.shutdown()
+        server.server_close()
+        store.close()
+
+
+def shard_client(args: tuple) -> None:
+    port, n, seed = args
+    rng = random.Random(seed)
+    conn = http.client.HTTPConnection("localhost", port)
+    for _ in range(n):
+        # the regex scan runs on every shard, each on its own core
+        msg = Get(k=f"k{rng.randrange(10000)}") if rng.random() < 0.5 else Select(k=f"k{rng.randrange(10)}.*5$")
+        conn.request("POST", "/", msg.serialize())
+        conn.getresponse().read()
+    conn.close()
+
+
+def bench_shards(args: argparse.Namespace) -> None:
+    context = multiprocessing.get_context("fork")
+    for shards in range(1, args.max_shards + 1):
+        with tempfile.TemporaryDirectory() as d:
+            open_store = lambda directory: Store(directory, WALEngine(directory, fsync="never"))
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                launcher = context.Process(target=shard.launch, args=(d, shards, ("localhost", args.port), open_store))
+                launcher.start()
+                conn = http.client.HTTPConnection("localhost", args.port)
+                for _ in range(100):
+                    try:
+                        conn.request("POST", "/pipeline", b"".join(frame(Insert(k=f"k{i}", v={"id": i})) for i in range(10000)))
+                        conn.getresponse().read()
+                        break
+                    except ConnectionRefusedError:
+                        conn.close()
+                        time.sleep(0.1)
+
+                with context.Pool(args.clients) as pool:
+                    start = time.perf_counter()
+                    pool.map(shard_client, [(args.port, args.n, i) for i in range(args.clients)])
+                    seconds = time.perf_counter() - start
+
+                conn.request("POST", "/", Shutdown().serialize())
+                conn.getresponse().read()
+                conn.close()
+                launcher.join()
+        print(f"{shards} shards: {args.clients * args.n / seconds:.0f} requests/s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(required=True)
+
+    codec = commands.add_parser("codec", help="on-disk value encoding vs JSON")
+    codec.add_argument("-n", type=int, default=10000)
+    codec.add_argument("--rounds", type=int, default=5)
+    codec.add_argument("--compress-threshold", type=int, default=256)
+    codec.set_defaults(run=bench_codec)
+
+    select = commands.add_parser("select", help="prefix-narrowed select vs a full key scan")
+    select.add_argument("-n", type=int, default=1000000)
+    select.add_argument("--rounds", type=int, default=5)
+    select.set_defaults(run=bench_select)
+
+    keepalive = commands.add_parser("keepalive", help="kept-alive connections vs one per request")
+    keepalive.add_argument("-n", type=int, default=5000)
+    keepalive.add_argument("--rounds", type=int, default=3)
+    keepalive.set_defaults(run=bench_keepalive)
+
+    pipeline = commands.add_parser("pipeline", help="pipelined POST bodies vs one message per request")
+    pipeline.add_argument("-n", type=int, default=2000)
+    pipeline.add_argument("--batch", type=int, default=100)
+    pipeline.add_argument("--rounds", type=int, default=3)
+    pipeline.add_argument("--fsync", choices=["always", "interval", "never"], default="always")
+    pipeline.set_defaults(run=bench_pipeline)
+
+    shards = commands.add_parser("shards", help="request rate as worker processes are added")
+    shards.add_argument("-n", type=int, default=200, help="requests per client")
+    shards.add_argument("--clients", type=int, default=8)
+    shards.add_argument("--max-shards", type=int, default=os.cpu_count())
+    shards.add_argument("--port", type=int, default=8100)
+    shards.set_defaults(run=bench_shards)
+
+    args = parser.parse_args()
+    args.run(args)
@@ -0,0 +1,297 @@
+from threading import Thread, Event, Lock
+from engine import Engine
+from codec import Codec
+import os
+import mmap
+import struct
+import zlib
+
+# Data records are <crc32><key length><value length><key><value>, with a
+# value length of -1 marking a tombstone. Hint records are
+# <key length><value offset><value length><key> and only exist for compacted
+# segments, which hold every live value written before them.
+HEADER = struct.Struct("<IIi")
+HINT = struct.Struct("<IQI")
+
+type segment = tuple[int, int]
+
+
+class BitcaskEngine(Engine):
+    def __init__(
+        self,
+        name: str,
+        fsync: bool = True,
+        max_segment: int = 64 << 20,
+        compact_interval: float | None = None,
+        compact_ratio: float = 0.5,
+        codec: Codec | None = None,
+    ) -> None:
+        self.name = name
+        self.codec = codec if codec is not None else Codec()
+        self.fsync = fsync
+        self.max_segment = max_segment
+        self.compact_ratio = compact_ratio
+
+        self.lock = Lock()
+        # key -> (segment, value offset, value length)
+        self.keydir = {}
+        # segment -> [size, dead bytes]
+        self.segments = {}
+        self.fds = {}
+        # inactive segments never change, so values are read through mmap
+        self.maps = {}
+        self.active = None
+        self.file = None
+        self.compactions = 0
+        os.makedirs(self.name, exist_ok=True)
+
+        self.stopped = Event()
+        self.thread = None
+        if compact_interval is not None:
+            self.thread = Thread(target=self.run, args=(compact_interval,), daemon=True)
+            self.thread.start()
+
+    def path(self, seg: segment, ext: str) -> str:
+        return f"{self.name}/{seg[0]:08d}-{seg[1]:04d}.{ext}"
+
+    def fd(self, seg: segment) -> int:
+        if seg not in self.fds:
+            self.fds[seg] = os.open(self.path(seg, "data"), os.O_RDONLY)
+        return self.fds[seg]
+
+    def map(self, seg: segment) -> mmap.mmap:
+        if seg not in self.maps:
+            self.maps[seg] = mmap.mmap(self.fd(seg), 0, access=mmap.ACCESS_READ)
+        return self.maps[seg]
+
+    def index(self) -> dict:
+        with self.lock:
+            return self.build_index()
+
+    def build_index(self) -> dict:
+        self.release()
+        self.keydir = {}
+        self.segments = {}
+
+        segs = []
+        for entry in os.scandir(self.name):
+            if entry.name.endswith(".tmp"):
+                os.remove(entry.path)
+            elif entry.name.endswith(".data"):
+                n, gen = entry.name[: -len(".data")].split("-")
+                segs.append((int(n), int(gen)))
+        segs.sort()
+
+        # a compacted segment supersedes everything before it, leftovers
+        # only exist if we crashed before the compaction cleaned them up
+        compacted = [s for s in segs if os.path.exists(self.path(s, "hint"))]
+        if compacted:
+            for s in segs:
+                if s < compacted[-1]:
+                    self.remove(s)
+            segs = [s for s in segs if s >= compacted[-1]]
+
+        for seg in segs:
+            if os.path.exists(self.path(seg, "hint")):
+                self.read_hint(seg)
+            else:
+                self.scan(seg)
+
+        self.active = (segs[-1][0] + 1, 0) if segs else (0, 0)
+        return self.keydir
+
+    def read_hint(self, seg: segment) -> None:
+        with open(self.path(seg, "hint"), "rb") as f:
+            data = f.read()
+        self.segments[seg] = [os.path.getsize(self.path(seg, "data")), 0]
+        offset = 0
+        while offset < len(data):
+            klen, voff, vlen = HINT.unpack_from(data, offset)
+            offset += HINT.size
+            k = data[offset : offset + klen].decode()
+            offset += klen
+            self.keydir[k] = (seg, voff, vlen)
+
+    def scan(self, seg: segment) -> None:
+        with open(self.path(seg, "data"), "rb") as f:
+            data = f.read()
+        self.segments[seg] = [0, 0]
+        offset = 0
+        while offset + HEADER.size <= len(data):
+            crc, klen, vlen = HEADER.unpack_from(data, offset)
+            start = offset + HEADER.size
+            end = start + klen + max(vlen, 0)
+            if end > len(data) or zlib.crc32(data[start:end]) != crc:
+                break
+            k = data[start : start + klen].decode()
+            self.forget(k)
+            if vlen < 0:
+                self.segments[seg][1] += end - offset
+            else:
+                self.keydir[k] = (seg, start + klen, vlen)
+            self.segments[seg][0] = offset = end
+
+        if offset < len(data):
+            os.truncate(self.path(seg, "data"), offset)
+
+    def forget(self, k: str) -> None:
+        old = self.keydir.pop(k, None)
+        if old is not None:
+            seg, _, vlen = old
+            self.segments[seg][1] += HEADER.size + len(k.encode()) + vlen
+
+    def remove(self, seg: segment) -> None:
+        if seg in self.maps:
+            self.maps.pop(seg).close()
+        if seg in self.fds:
+            os.close(self.fds.pop(seg))
+        self.segments.pop(seg, None)
+        for ext in ("data", "hint"):
+            try:
+                os.remove(self.path(seg, ext))
+            except FileNotFoundError:
+                pass
+
+    def read(self, k: str) -> dict:
+        with self.lock:
+            seg, offset, length = self.keydir[k]
+            if seg == self.active:
+                if self.file is not None:
+                    self.file.flush()
+                data = os.pread(self.fd(seg), length, offset)
+            else:
+                data = self.map(seg)[offset : offset + length]
+        return self.codec.decode(data)
+
+    def load(self) -> dict:
+        return {k: self.read(k) for k in self.index()}
+
+    def append(self, k: str, v: bytes | None) -> tuple[segment, int, int]:
+        key = k.encode()
+        vlen = -1 if v is None else len(v)
+        body = key + (v or b"")
+        record = HEADER.pack(zlib.crc32(body), len(key), vlen) + body
+
+        if self.file is None or self.segments[self.active][0] >= self.max_segment:
+            self.rotate()
+
+        size = self.segments[self.active][0]
+        self.file.write(record)
+        self.segments[self.active][0] += len(record)
+        return (self.active, size + HEADER.size + len(key), vlen)
+
+    def rotate(self) -> None:
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.active = (self.active[0] + 1, 0)
+        self.file = open(self.path(self.active, "data"), "ab")
+        self.segments[self.active] = [0, 0]
+
+    def insert(self, k: str, v: dict) -> None:
+        v = self.codec.encode(v)
+        with self.lock:
+            self.forget(k)
+            self.keydir[k] = self.append(k, v)
+
+    def delete(self, k: str) -> None:
+        with self.lock:
+            self.forget(k)
+            seg, _, _ = self.append(k, None)
+            self.segments[seg][1] += HEADER.size + len(k.encode())
+
+    def save(self, items: dict) -> None:
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+
+    def should_compact(self) -> bool:
+        with self.lock:
+            inactive = [s for s in self.segments if s != self.active]
+            size = sum(self.segments[s][0] for s in inactive)
+            dead = sum(self.segments[s][1] for s in inactive)
+        return size > 0 and dead / size >= self.compact_ratio
+
+    def compact(self) -> None:
+        with self.lock:
+            inputs = sorted(s for s in self.segments if s != self.active)
+            if not inputs:
+                return
+            merged = set(inputs)
+            live = [(k, loc) for k, loc in self.keydir.items() if loc[0] in merged]
+            fds = {s: self.fd(s) for s in inputs}
+
+        # the output sorts after its inputs and before the active segment,
+        # so replaying a directory where the inputs survived a crash still
+        # lets the compacted values win
+        target = (inputs[-1][0], inputs[-1][1] + 1)
+        moved = {}
+        hint = []
+        with open(self.path(target, "data") + ".tmp", "wb") as f:
+            size = 0
+            for k, (seg, offset, length) in live:
+                key = k.encode()
+                v = os.pread(fds[seg], length, offset)
+                f.write(HEADER.pack(zlib.crc32(key + v), len(key), length) + key + v)
+                moved[k] = (target, size + HEADER.size + len(key), length)
+                hint.append(HINT.pack(len(key), moved[k][1], length) + key)
+                size += HEADER.size + len(key) + length
+            f.flush()
+            os.fsync(f.fileno())
+        with open(self.path(target, "hint") + ".tmp", "wb") as f:
+            f.write(b"".join(hint))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.path(target, "data") + ".tmp", self.path(target, "data"))
+        os.replace(self.path(target, "hint") + ".tmp", self.path(target, "hint"))
+
+        with self.lock:
+            self.segments[target] = [size, 0]
+            for k, loc in live:
+                if self.keydir.get(k) == loc:
+                    self.keydir[k] = moved[k]
+                else:
+                    self.segments[target][1] += HEADER.size + len(k.encode()) + loc[2]
+            for s in inputs:
+                self.remove(s)
+            self.compactions += 1
+
+    def run(self, interval: float) -> None:
+        while not self.stopped.wait(interval):
+            if self.should_compact():
+                self.compact()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "keys": len(self.keydir),
+                "segments": len(self.segments),
+                "bytes": sum(size for size, _ in self.segments.values()),
+                "dead_bytes": sum(dead for _, dead in self.segments.values()),
+                "compactions": self.compactions,
+                "codec": self.codec.stats(),
+            }
+
+    def close(self) -> None:
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        with self.lock:
+            self.release()
+
+    def release(self) -> None:
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
+        for m in self.maps.values():
+            m.close()
+        self.maps = {}
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds = {}
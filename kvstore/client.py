@@ -1,7 +1,10 @@
 
 import http.client
-from message import Insert, Get, Delete, Select, Message
+from message import Insert, Get, Delete, Select, Stats, Snapshot, CreateIndex, Query, Aggregate, DeleteRange, Count, MultiInsert, MultiGet, MultiDelete, Transaction, Message
+from message import frame, read_response
+import io
 import json
+import socket
 import sys
 
 def parse_json_and_rest(s: str):
@@ -20,19 +23,58 @@ class Client:
         self.host = host
         self.port = port
         self.conn = http.client.HTTPConnection(self.host, self.port)
+        # version of the key the last request touched, from its ETag
+        self.version = None
 
     def request(self, msg: Message):
+        resp = self.post("/", self.prefixed(msg).serialize())
+        etag = resp.getheader("ETag")
+        self.version = int(etag.strip('"')) if etag is not None else None
+        resp = resp.read().decode()
+        print(resp)
+        return resp
+
+    # Sends every message in one body, they are run in order and persisted
+    # together before any of them is answered.
+    def pipeline(self, msgs: list[Message]) -> list[str]:
+        resp = self.post("/pipeline", b"".join(frame(self.prefixed(msg)) for msg in msgs))
+        if resp.status != 200:
+            resp = resp.read().decode()
+            print(resp)
+            return [resp] * len(msgs)
+        body = io.BytesIO(resp.read())
+        resps = []
+        for _ in msgs:
+            _, resp, self.version = read_response(body)
+            resp = resp.decode()
+            print(resp)
+            resps.append(resp)
+        return resps
+
+    def post(self, path: str, payload: bytes) -> http.client.HTTPResponse:
+        try:
+            self.conn.request("POST", path, payload)
+            return self.conn.getresponse()
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            # the server closed the kept-alive connection while it was idle,
+            # before reading the request, so it is safe to send it again
+            self.conn.close()
+            self.conn.request("POST", path, payload)
+            return self.conn.getresponse()
+
+    def prefixed(self, msg: Message) -> Message:
         # Add prefix to key
         # important: This is a bug
         if hasattr(msg, "k"):
             msg.k = self.prefix + "_" + msg.k
-
-        payload = msg.serialize()
-        self.conn.request("POST", "/", payload)
-        resp = self.conn.getresponse()
-        resp = resp.read().decode()
-        print(resp)
-        return resp
+        if hasattr(msg, "ks"):
+            msg.ks = [self.prefix + "_" + k for k in msg.ks]
+        if hasattr(msg, "kvs"):
+            msg.kvs = [[self.prefix + "_" + k, v] for k, v in msg.kvs]
+        if isinstance(msg, Transaction):
+            msg.ops = [[op[0], self.prefix + "_" + op[1], *op[2:]] for op in msg.ops]
+            msg.checks = [check | {"key": self.prefix + "_" + check["key"]} for check in msg.checks]
+        return msg
 
     def close(self):
         self.conn.close()
@@ -42,10 +84,41 @@ class Client:
     
     def __repr__(self):
         return str(self)
+
+
+# Talks to a TCPStoreServer over one raw connection.
+class TCPClient(Client):
+    def __init__(self, host, port, prefix=""):
+        self.prefix = prefix
+        self.host = host
+        self.port = port
+        self.sock = socket.create_connection((host, port))
+        self.file = self.sock.makefile("rb")
+        self.version = None
+        self.status = None
+
+    def request(self, msg: Message):
+        return self.pipeline([msg])[0]
+
+    # Sends every message before reading any answer.
+    def pipeline(self, msgs: list[Message]) -> list[str]:
+        self.sock.sendall(b"".join(frame(self.prefixed(msg)) for msg in msgs))
+        resps = []
+        for _ in msgs:
+            self.status, body, self.version = read_response(self.file)
+            resp = body.decode()
+            print(resp)
+            resps.append(resp)
+        return resps
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
         
 if __name__ == '__main__':
-    prefix = sys.argv[1] if len(sys.argv) > 1 else ""
-    c = Client('localhost', 8000, prefix)
+    args = [arg for arg in sys.argv[1:] if arg != "--tcp"]
+    prefix = args[0] if args else ""
+    c = (TCPClient if "--tcp" in sys.argv else Client)('localhost', 8000, prefix)
 
     marker = "skv> " if prefix == "" else f"skv<[{prefix}]> "
 
@@ -66,6 +139,25 @@ if __name__ == '__main__':
 
                 c.request(Insert(k=k, v=json.loads(v)))
             
+            case ".insertif":
+                args = cmd.split(" ", 3)
+                if len(args) != 4:
+                    print("Usage: .insertif <version> <key> <value>")
+                    continue
+
+                (_, version, k, v) = args
+                c.request(Insert(k=k, v=json.loads(v), if_version=int(version)))
+                print(f"version {c.version}")
+
+            case ".deleteif":
+                args = cmd.split(" ", 2)
+                if len(args) != 3:
+                    print("Usage: .deleteif <version> <key>")
+                    continue
+
+                (_, version, k) = args
+                c.request(Delete(k=k, if_version=int(version)))
+
             case ".insertmany":
                 args = cmd.split(" ", 1)
                 if len(args) != 2:
@@ -81,10 +173,20 @@ if __name__ == '__main__':
                         break
                     documents.append(doc)
 
+                kvs = []
                 for doc in documents:
                     assert isinstance(doc, dict)
-                    for key in doc:
-                        c.request(Insert(k=key, v=doc[key]))
+                    kvs.extend(doc.items())
+                c.request(MultiInsert(kvs=kvs))
+
+            case ".getmany" | ".deletemany":
+                args = cmd.split(" ")
+                if len(args) < 2:
+                    print(f"Usage: {typ} <key>+")
+                    continue
+
+                cls = MultiGet if typ == ".getmany" else MultiDelete
+                c.request(cls(ks=args[1:]))
 
             case ".get":
                 args = cmd.split(" ", 1)
@@ -94,6 +196,7 @@ if __name__ == '__main__':
 
                 (_, k) = args
                 c.request(Get(k=k))
+                print(f"version {c.version}")
 
             case ".select":
                 args = cmd.split(" ", 1)
@@ -104,6 +207,50 @@ if __name__ == '__main__':
                 (_, k) = args
                 c.request(Select(k=k))
 
+            case ".glob":
+                args = cmd.split(" ", 1)
+                if len(args) != 2:
+                    print("Usage: .glob <pattern>")
+                    continue
+
+                (_, k) = args
+                c.request(Select(k=k, opts={"glob": True}))
+
+            case ".page":
+                args = cmd.split(" ", 2)
+                if len(args) != 3:
+                    print("Usage: .page <limit> <key>")
+                    continue
+
+                (_, limit, k) = args
+                cursor = None
+                while True:
+                    resp = c.request(Select(k=k, opts={"limit": int(limit), "cursor": cursor}))
+                    try:
+                        cursor = json.loads(resp)["cursor"]
+                    except (json.JSONDecodeError, KeyError):
+                        break
+                    if cursor is None or input("more? [Y/n] ").lower() == "n":
+                        break
+
+            case ".keys" | ".count":
+                args = cmd.split(" ", 1)
+                if len(args) != 2:
+                    print(f"Usage: {typ} <key>")
+                    continue
+
+                (_, k) = args
+                c.request(Select(k=k, opts={typ[1:]: True}))
+
+            case ".project":
+                args = cmd.split(" ", 2)
+                if len(args) != 3:
+                    print("Usage: .project <field,...> <key>")
+                    continue
+
+                (_, fields, k) = args
+                c.request(Select(k=k, opts={"fields": fields.split(",")}))
+
             case ".delete":
                 args = cmd.split(" ", 1)
                 if len(args) != 2:
@@ -113,6 +260,61 @@ if __name__ == '__main__':
                 (_, k) = args
                 c.request(Delete(k=k))
 
+            case ".index":
+                args = cmd.split(" ")
+                if len(args) not in (2, 3):
+                    print("Usage: .index <field> [hash|ordered]")
+                    continue
+
+                c.request(CreateIndex(field=args[1], kind=args[2] if len(args) == 3 else "hash"))
+
+            case ".query":
+                args = cmd.split(" ", 2)
+                if len(args) != 3:
+                    print("Usage: .query <field> <where>")
+                    continue
+
+                (_, field, where) = args
+                c.request(Query(field=field, where=json.loads(where)))
+
+            case ".aggregate":
+                args = cmd.split(" ")
+                if len(args) not in (2, 3, 4):
+                    print("Usage: .aggregate <key> [field] [by]")
+                    continue
+
+                (k, field, by) = (args[1:] + [None, None])[:3]
+                c.request(Aggregate(k=k, field=field, by=by))
+
+            case ".deleterange" | ".countrange":
+                args = cmd.split(" ", 1)
+                if len(args) != 2:
+                    print(f"Usage: {typ} <prefix>")
+                    continue
+
+                (_, k) = args
+                cls = DeleteRange if typ == ".deleterange" else Count
+                c.request(cls(k=k, opts={"prefix": True}))
+
+            case ".transaction":
+                args = cmd.split(" ", 1)
+                if len(args) != 2:
+                    print("Usage: .transaction <ops> [checks]")
+                    continue
+
+                ops, rest = parse_json_and_rest(args[1])
+                checks, _ = parse_json_and_rest(rest)
+                if not isinstance(ops, list):
+                    print("Usage: .transaction <ops> [checks]")
+                    continue
+                c.request(Transaction(ops=ops, checks=checks or []))
+
+            case ".stats":
+                c.request(Stats())
+
+            case ".snapshot":
+                c.request(Snapshot())
+
             case ".exit":
                 c.close()
                 break
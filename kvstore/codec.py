@@ -0,0 +1,118 @@
+from message import serialize, read, type_
+from collections import Counter
+import json
+import re
+import time
+import zlib
+
+# JSON text never starts with one of the type markers, so both formats can
+# be read side by side.
+JSON_START = b'{["-0123456789tfnIN'
+
+
+# The C json module writes and parses values several times faster than the
+# typed encoding can in pure Python, so values are stored as compact JSON.
+# Values JSON can not hold, such as bytes, are written in the typed encoding
+# so they still round-trip exactly. `typed` always uses it.
+def encode(v: object, typed: bool = False) -> bytes:
+    if not typed:
+        try:
+            return json.dumps(v, separators=(",", ":")).encode()
+        except TypeError:
+            pass
+    return serialize(type_(v), v)
+
+
+def decode(data: bytes) -> object:
+    if data[0] in JSON_START:
+        return json.loads(data)
+    _, value, _ = read(data, 0)
+    return value
+
+
+# Values whose encoding reaches `threshold` bytes are zlib-compressed and
+# stored behind a `~` marker, smaller ones stay raw. A preset dictionary
+# (see train()) helps with many similar documents, and has to be the same
+# one every time the store is opened. `typed` stores every value in the
+# typed encoding, see encode().
+class Codec:
+    def __init__(
+        self,
+        threshold: int | None = None,
+        level: int = 6,
+        zdict: bytes | None = None,
+        typed: bool = False,
+    ) -> None:
+        self.threshold = threshold
+        self.level = level
+        self.zdict = zdict
+        self.typed = typed
+
+        self.compressed = 0
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+        self.compress_seconds = 0.0
+        self.decompress_seconds = 0.0
+
+    def encode(self, v: object) -> bytes:
+        data = encode(v, self.typed)
+        if self.threshold is None or len(data) < self.threshold:
+            return data
+
+        start = time.perf_counter()
+        if self.zdict is None:
+            compressor = zlib.compressobj(self.level)
+        else:
+            compressor = zlib.compressobj(self.level, zdict=self.zdict)
+        compressed = b"~" + compressor.compress(data) + compressor.flush()
+        self.compress_seconds += time.perf_counter() - start
+
+        if len(compressed) >= len(data):
+            return data
+        self.compressed += 1
+        self.raw_bytes += len(data)
+        self.stored_bytes += len(compressed)
+        return compressed
+
+    def decode(self, data: bytes) -> object:
+        if data[:1] == b"~":
+            start = time.perf_counter()
+            if self.zdict is None:
+                decompressor = zlib.decompressobj()
+            else:
+                decompressor = zlib.decompressobj(zdict=self.zdict)
+            data = decompressor.decompress(data[1:]) + decompressor.flush()
+            self.decompress_seconds += time.perf_counter() - start
+        return decode(data)
+
+    def stats(self) -> dict:
+        return {
+            "typed": self.typed,
+            "threshold": self.threshold,
+            "compressed": self.compressed,
+            "raw_bytes": self.raw_bytes,
+            "stored_bytes": self.stored_bytes,
+            "ratio": self.raw_bytes / self.stored_bytes if self.stored_bytes else 1.0,
+            "compress_ms": 1000 * self.compress_seconds,
+            "decompress_ms": 1000 * self.decompress_seconds,
+        }
+
+
+# zlib looks back at most 32KB, so the most useful preset dictionary is the
+# most common field names and values of the sampled documents, most frequent
+# last where they are cheapest to reference. Pieces end after every comma
+# and line break, so this works for both encodings.
+def train(samples: list[object], size: int = 32 << 10, typed: bool = False) -> bytes:
+    counts = Counter()
+    for v in samples:
+        data = encode(v, typed)
+        for piece in re.split(rb"(?<=,)|(?<=\r\n)", data):
+            if piece:
+                counts[piece] += 1
+
+    zdict = b""
+    for piece, n in counts.most_common():
+        if n < 2 or len(zdict) + len(piece) > size:
+            break
+        zdict = piece + zdict
+    return zdict
@@ -0,0 +1,55 @@
+from concurrent.futures import ThreadPoolExecutor
+from bitcask import BitcaskEngine
+from codec import Codec
+from engine import CLOCK
+import argparse
+import os
+import time
+
+
+# Migrates a one-file-per-key directory into a single compacted Bitcask
+# segment with a hint file, so the next boot only has to read the hints.
+def convert(src: str, dst: str, workers: int = 8) -> int:
+    if os.path.exists(dst) and os.listdir(dst):
+        raise ValueError(f"Destination '{dst}' is not empty")
+
+    # the source is only read, a FileEngine on it would clear its temp files
+    codec = Codec()
+
+    def read(k: str) -> dict:
+        with open(f"{src}/{k}", "rb") as f:
+            return codec.decode(f.read())
+
+    keys = [
+        entry.name
+        for entry in os.scandir(src)
+        if not entry.is_dir() and entry.name not in (CLOCK, CLOCK + ".tmp")
+    ]
+    with ThreadPoolExecutor(max(workers, 1)) as pool:
+        items = dict(zip(keys, pool.map(read, keys)))
+    print(f"read {len(items)} keys from {src}")
+
+    engine = BitcaskEngine(dst, fsync=False)
+    engine.index()
+    for k, v in items.items():
+        engine.insert(k, v)
+    engine.close()
+
+    # once reopened every written segment is inactive and gets merged
+    engine = BitcaskEngine(dst)
+    engine.index()
+    engine.compact()
+    engine.close()
+    return len(items)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("src")
+    parser.add_argument("dst")
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    n = convert(args.src, args.dst, args.workers)
+    print(f"converted {n} keys in {time.perf_counter() - start:.2f}s")
@@ -0,0 +1,221 @@
+from abc import ABC, abstractmethod
+from typing import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from codec import Codec
+import os
+import time
+
+
+class Engine(ABC):
+    @abstractmethod
+    def load(self) -> dict:
+        pass
+
+    @abstractmethod
+    def save(self, items: dict) -> None:
+        pass
+
+    def insert(self, k: str, v: dict) -> None:
+        pass
+
+    def delete(self, k: str) -> None:
+        pass
+
+    # Raises ValueError for a key the engine can not store, the store asks
+    # before it applies a write.
+    def check(self, k: str) -> None:
+        pass
+
+    # Applies ["insert", k, v] and ["delete", k] ops together. Engines that
+    # can make the whole batch durable as one unit override this.
+    def batch(self, ops: list[list]) -> None:
+        for op in ops:
+            match op:
+                case ["insert", k, v]:
+                    self.insert(k, v)
+                case ["delete", k]:
+                    self.delete(k)
+                case _:
+                    raise ValueError(f"Unsupported op: {op}")
+
+    # Engines that can locate a single value on disk support lazy loading:
+    # index() lists the keys without decoding values and read() fetches one.
+    def index(self) -> Iterable[str]:
+        raise NotImplementedError(f"{type(self).__name__} does not support lazy loading")
+
+    def read(self, k: str) -> dict:
+        raise NotImplementedError(f"{type(self).__name__} does not support lazy loading")
+
+    def snapshot(self, items: dict) -> None:
+        raise NotImplementedError(f"{type(self).__name__} does not support snapshots")
+
+    def stats(self) -> dict:
+        return {}
+
+    def close(self) -> None:
+        pass
+
+
+# Marks a key in a pending batch as deleted rather than written.
+TOMBSTONE = object()
+
+# The store keeps the high-water mark of its version clock in this file
+# beside the data, see Store.
+CLOCK = ".clock"
+
+
+class FileEngine(Engine):
+    def __init__(
+        self,
+        name: str,
+        fsync: bool = True,
+        workers: int = 8,
+        batch: int = 1024,
+        progress: bool = False,
+        codec: Codec | None = None,
+    ) -> None:
+        self.name = name
+        self.codec = codec if codec is not None else Codec()
+        self.tmp = f"{name}/.tmp"
+        # names in the directory that are not keys
+        self.reserved = {".tmp", CLOCK, CLOCK + ".tmp"}
+        self.fsync = fsync
+        self.workers = workers
+        self.batch_size = batch
+        self.progress = progress
+        self.dirty = {}
+        # the batch a save is writing out, still served to lazy reads
+        self.saving = {}
+        self.lock = Lock()
+        self.save_lock = Lock()
+        self.loaded = 0
+        self.load_seconds = 0.0
+        os.makedirs(self.tmp, exist_ok=True)
+
+    def insert(self, k: str, v: dict) -> None:
+        with self.lock:
+            self.dirty[k] = v
+
+    def delete(self, k: str) -> None:
+        with self.lock:
+            self.dirty[k] = TOMBSTONE
+
+    # the temp directory and the store's clock live among the keys
+    def check(self, k: str) -> None:
+        if k in self.reserved:
+            raise ValueError(f"Reserved key: {k}")
+
+    def save(self, items: dict) -> None:
+        # saves run one at a time, they share the temp file
+        with self.save_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                dirty, self.dirty = self.dirty, {}
+                self.saving = dirty
+            try:
+                self.write(dirty)
+            except BaseException:
+                # what was not written goes back, behind any newer writes
+                with self.lock:
+                    self.dirty = dirty | self.dirty
+                raise
+            finally:
+                with self.lock:
+                    self.saving = {}
+
+    # Keys leave `dirty` as they are written. One that fails stays and the
+    # rest are still written, the first error is raised at the end.
+    def write(self, dirty: dict) -> None:
+        error = None
+        for k, v in list(dirty.items()):
+            try:
+                self.write_one(k, v)
+            except OSError as e:
+                error = error or e
+                continue
+            del dirty[k]
+
+        if self.fsync:
+            fd = os.open(self.name, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        if error is not None:
+            raise error
+
+    def write_one(self, k: str, v: dict) -> None:
+        path = f"{self.name}/{k}"
+        if v is TOMBSTONE:
+            try:
+                os.remove(path)
+            except (FileNotFoundError, NotADirectoryError):
+                # never written, or could never have been
+                pass
+            return
+
+        # write a temp file and rename it over the target, so a crash
+        # leaves either the old or the new value but never a partial one
+        tmp = f"{self.tmp}/{os.getpid()}"
+        with open(tmp, "wb") as f:
+            f.write(self.codec.encode(v))
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def index(self) -> list[str]:
+        self.dirty = {}
+        for k in os.listdir(self.tmp):
+            os.remove(f"{self.tmp}/{k}")
+
+        return [
+            entry.name
+            for entry in os.scandir(self.name)
+            if not entry.is_dir() and entry.name not in self.reserved
+        ]
+
+    def read(self, k: str) -> dict:
+        with self.lock:
+            if k in self.dirty:
+                return self.dirty[k]
+            if k in self.saving:
+                return self.saving[k]
+        with open(f"{self.name}/{k}", "rb") as f:
+            return self.codec.decode(f.read())
+
+    def read_batch(self, keys: list[str]) -> list[tuple[str, dict]]:
+        return [(k, self.read(k)) for k in keys]
+
+    def load(self) -> dict:
+        start = time.perf_counter()
+        keys = self.index()
+        batches = [keys[i : i + self.batch_size] for i in range(0, len(keys), self.batch_size)]
+
+        items = {}
+        if len(batches) <= 1 or self.workers <= 1:
+            for batch in batches:
+                items.update(self.read_batch(batch))
+        else:
+            # opening and reading the files releases the GIL, so a pool
+            # overlaps the I/O of many small files
+            with ThreadPoolExecutor(self.workers) as pool:
+                for batch in pool.map(self.read_batch, batches):
+                    items.update(batch)
+                    if self.progress:
+                        elapsed = time.perf_counter() - start
+                        print(f"loaded {len(items)}/{len(keys)} keys ({len(items) / elapsed:.0f} keys/s)")
+
+        self.loaded = len(items)
+        self.load_seconds = time.perf_counter() - start
+        return items
+
+    def stats(self) -> dict:
+        return {
+            "codec": self.codec.stats(),
+            "loaded": self.loaded,
+            "load_ms": 1000 * self.load_seconds,
+            "load_keys_per_s": self.loaded / self.load_seconds if self.load_seconds else 0,
+        }
@@ -0,0 +1,189 @@
+from typing import Literal, Iterable
+from threading import Thread, Condition, Lock
+from engine import Engine, TOMBSTONE
+import time
+
+type durability = Literal["sync", "group", "async"]
+
+
+# Coalesces mutations in memory and hands them to the wrapped engine in
+# batches: `sync` flushes on the request path, `group` waits for the
+# background batch that contains the request, `async` returns right away.
+# Durability comes from the wrapped engine's save(), so it should fsync.
+class GroupCommit(Engine):
+    def __init__(
+        self,
+        engine: Engine,
+        mode: durability = "group",
+        interval: float = 0.01,
+        max_bytes: int = 1 << 20,
+    ) -> None:
+        if mode not in ("sync", "group", "async"):
+            raise ValueError(f"Unsupported durability mode: {mode}")
+        self.engine = engine
+        self.mode = mode
+        self.interval = interval
+        self.max_bytes = max_bytes
+
+        self.cond = Condition()
+        self.flush_lock = Lock()
+        self.pending = {}
+        self.pending_bytes = 0
+        self.items = {}
+        # batches are numbered so `group` writers can wait for theirs
+        self.batch_seq = 0
+        self.flushed = 0
+        self.last_write = 0
+        # the last batch the wrapped engine refused, and why
+        self.failed = 0
+        self.error = None
+        self.stopped = False
+
+        self.flushes = 0
+        self.mutations = 0
+        self.flushed_keys = 0
+        self.max_batch = 0
+        self.flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+
+        self.thread = None
+        if self.mode != "sync":
+            self.thread = Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def load(self) -> dict:
+        self.items = self.engine.load()
+        return self.items
+
+    def index(self) -> Iterable[str]:
+        return self.engine.index()
+
+    # an evicted value may still be waiting for the next batch
+    def read(self, k: str) -> dict:
+        with self.cond:
+            if k in self.pending:
+                return self.pending[k]
+        with self.flush_lock:
+            return self.engine.read(k)
+
+    def insert(self, k: str, v: dict) -> None:
+        self.batch([["insert", k, v]])
+
+    def check(self, k: str) -> None:
+        self.engine.check(k)
+
+    def delete(self, k: str) -> None:
+        self.batch([["delete", k]])
+
+    # all of `ops` land in the same flush, which the wrapped engine gets as
+    # one batch
+    def batch(self, ops: list[list]) -> None:
+        with self.cond:
+            for op in ops:
+                match op:
+                    case ["insert", k, v]:
+                        self.pending[k] = v
+                        self.pending_bytes += len(k) + len(str(v))
+                    case ["delete", k]:
+                        self.pending[k] = TOMBSTONE
+                        self.pending_bytes += len(k)
+            self.last_write = self.batch_seq + 1
+            self.mutations += len(ops)
+            if self.pending_bytes >= self.max_bytes:
+                self.cond.notify_all()
+
+    def save(self, items: dict) -> None:
+        self.items = items
+        match self.mode:
+            case "sync":
+                self.flush()
+            case "group":
+                with self.cond:
+                    target = self.last_write
+                    while self.flushed < target and not self.stopped:
+                        if self.failed >= target:
+                            raise self.error
+                        self.cond.wait()
+            case "async":
+                pass
+
+    def flush(self) -> None:
+        with self.flush_lock:
+            with self.cond:
+                if not self.pending:
+                    return
+                pending, self.pending = self.pending, {}
+                self.pending_bytes = 0
+                self.batch_seq += 1
+                batch = self.batch_seq
+
+            start = time.perf_counter()
+            try:
+                self.engine.batch(
+                    [["delete", k] if v is TOMBSTONE else ["insert", k, v] for k, v in pending.items()]
+                )
+                self.engine.save(self.items)
+            except Exception as e:
+                # the batch goes back in front of newer writes and is tried
+                # again with the next one, its waiters get the error
+                with self.cond:
+                    self.pending = pending | self.pending
+                    self.pending_bytes += sum(len(k) + len(str(v)) for k, v in pending.items())
+                    self.failed = batch
+                    self.error = e
+                    self.cond.notify_all()
+                raise
+            elapsed = time.perf_counter() - start
+
+            with self.cond:
+                self.flushed = batch
+                self.flushes += 1
+                self.flushed_keys += len(pending)
+                self.max_batch = max(self.max_batch, len(pending))
+                self.flush_seconds += elapsed
+                self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+                self.cond.notify_all()
+
+    def snapshot(self, items: dict) -> None:
+        self.items = items
+        self.flush()
+        self.engine.snapshot(items)
+
+    def run(self) -> None:
+        while True:
+            with self.cond:
+                if self.stopped:
+                    return
+                if self.pending_bytes < self.max_bytes:
+                    self.cond.wait(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"flush failed, retrying: {e!r}")
+
+    def stats(self) -> dict:
+        with self.cond:
+            return {
+                "mode": self.mode,
+                "flushes": self.flushes,
+                "mutations": self.mutations,
+                "flushed_keys": self.flushed_keys,
+                "pending_keys": len(self.pending),
+                "avg_batch": self.flushed_keys / self.flushes if self.flushes else 0,
+                "max_batch": self.max_batch,
+                "avg_flush_ms": 1000 * self.flush_seconds / self.flushes if self.flushes else 0,
+                "max_flush_ms": 1000 * self.max_flush_seconds,
+                "error": repr(self.error) if self.error is not None else None,
+                "engine": self.engine.stats(),
+            }
+
+    def close(self) -> None:
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+        try:
+            self.flush()
+        finally:
+            self.engine.close()
@@ -0,0 +1,266 @@
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+
+
+# A sorted list of keys split into blocks of about `load` keys, so inserts
+# and deletes only shift one block instead of the whole index.
+class SortedKeys:
+    def __init__(self, keys=(), load: int = 1000) -> None:
+        self.load = load
+        keys = sorted(keys)
+        self.blocks = [keys[i : i + load] for i in range(0, len(keys), load)]
+        self.maxes = [block[-1] for block in self.blocks]
+        self.size = len(keys)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __iter__(self):
+        for block in self.blocks:
+            yield from block
+
+    def add(self, k: str) -> None:
+        if not self.blocks:
+            self.blocks.append([k])
+            self.maxes.append(k)
+            self.size += 1
+            return
+
+        i = min(bisect_left(self.maxes, k), len(self.blocks) - 1)
+        block = self.blocks[i]
+        j = bisect_left(block, k)
+        if j < len(block) and block[j] == k:
+            return
+        block.insert(j, k)
+        self.maxes[i] = block[-1]
+        self.size += 1
+
+        if len(block) > 2 * self.load:
+            self.blocks[i : i + 1] = [block[: self.load], block[self.load :]]
+            self.maxes[i : i + 1] = [block[self.load - 1], block[-1]]
+
+    def discard(self, k: str) -> None:
+        i = bisect_left(self.maxes, k)
+        if i == len(self.blocks):
+            return
+        block = self.blocks[i]
+        j = bisect_left(block, k)
+        if j == len(block) or block[j] != k:
+            return
+        del block[j]
+        self.size -= 1
+
+        if block:
+            self.maxes[i] = block[-1]
+        else:
+            del self.blocks[i]
+            del self.maxes[i]
+
+    # keys with lo <= key < hi, or every key from lo on without hi
+    def irange(self, lo: str = "", hi: str | None = None):
+        i = bisect_left(self.maxes, lo)
+        if i == len(self.blocks):
+            return
+        j = bisect_left(self.blocks[i], lo)
+        for block in self.blocks[i:]:
+            end = len(block) if hi is None else bisect_left(block, hi, j)
+            yield from block[j:end]
+            if end < len(block):
+                return
+            j = 0
+
+    # keys starting with p, only those past `after` when resuming a scan
+    def prefix(self, p: str, after: str | None = None):
+        lo = p if after is None or after < p else after
+        for k in self.irange(lo):
+            if not k.startswith(p):
+                return
+            if k != after:
+                yield k
+
+
+REGEX_SPECIAL = set(".^$*+?{}[]|()\\")
+
+
+# The literal text every match of `pattern` (anchored at the start, as in
+# re.match) has to begin with. Alternations and anything that is not a plain
+# or escaped character end the prefix, so the result is always safe to
+# narrow a scan with, if sometimes shorter than it could be.
+def literal_prefix(pattern: str) -> str:
+    if "|" in pattern:
+        return ""
+
+    prefix = []
+    i = 1 if pattern.startswith("^") else 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\":
+            if i + 1 == len(pattern) or pattern[i + 1].isalnum():
+                break
+            c = pattern[i + 1]
+            i += 2
+        elif c in REGEX_SPECIAL:
+            break
+        else:
+            i += 1
+
+        # a quantifier may repeat the character zero times
+        if i < len(pattern) and pattern[i] in "*?{":
+            break
+        prefix.append(c)
+        if i < len(pattern) and pattern[i] == "+":
+            break
+    return "".join(prefix)
+
+
+# Values of different types never compare equal in an index and sort by
+# type first. Dicts, lists and NaN are not indexed.
+TYPE_RANK = {type(None): 0, bool: 1, int: 2, float: 2, str: 3}
+
+
+def sort_key(v: object) -> tuple | None:
+    rank = TYPE_RANK.get(type(v))
+    if rank is None or v != v:
+        return None
+    return (rank, v)
+
+
+# Nulls are never indexed, so a query can not ask for them either.
+def bound(v: object) -> tuple:
+    sk = sort_key(v)
+    if sk is None or sk[0] == 0:
+        raise ValueError(f"Can not query an index for {v!r}")
+    return sk
+
+
+def resolve(v: object, path: list[str]) -> object:
+    for part in path:
+        if not isinstance(v, dict) or part not in v:
+            return None
+        v = v[part]
+    return v
+
+
+# A secondary index over the values at a dotted path inside dict values.
+# Records where the path is missing, or holds an unindexable value, are
+# left out, the same as a null there. Every index also maps each record key
+# to its indexed value, so the field can be read without the record.
+class FieldIndex(ABC):
+    kind = ""
+
+    def __init__(self, field: str) -> None:
+        self.field = field
+        self.path = field.split(".")
+        self.values: dict[str, tuple] = {}
+        self.build_ms = 0.0
+
+    def extract(self, value: object) -> tuple | None:
+        sk = sort_key(resolve(value, self.path))
+        return sk if sk is not None and sk[0] != 0 else None
+
+    def build(self, items) -> None:
+        for key, value in items:
+            self.add(key, value)
+
+    def add(self, key: str, value: object) -> None:
+        self.discard(key)
+        sk = self.extract(value)
+        if sk is not None:
+            self.values[key] = sk
+            self.insert(key, sk)
+
+    def discard(self, key: str) -> None:
+        sk = self.values.pop(key, None)
+        if sk is not None:
+            self.remove(key, sk)
+
+    @abstractmethod
+    def insert(self, key: str, sk: tuple) -> None:
+        pass
+
+    @abstractmethod
+    def remove(self, key: str, sk: tuple) -> None:
+        pass
+
+    # `where` holds "eq", or any of "gt", "gte", "lt" and "lte"
+    @abstractmethod
+    def find(self, where: dict):
+        pass
+
+    def stats(self) -> dict:
+        return {"kind": self.kind, "entries": len(self.values), "build_ms": self.build_ms}
+
+
+class HashIndex(FieldIndex):
+    kind = "hash"
+
+    def __init__(self, field: str) -> None:
+        super().__init__(field)
+        self.keys = {}
+
+    def insert(self, key: str, sk: tuple) -> None:
+        self.keys.setdefault(sk, set()).add(key)
+
+    def remove(self, key: str, sk: tuple) -> None:
+        keys = self.keys[sk]
+        keys.remove(key)
+        if not keys:
+            del self.keys[sk]
+
+    def find(self, where: dict):
+        if set(where) != {"eq"}:
+            raise ValueError(f"A hash index only supports eq, not {', '.join(where)}")
+        return sorted(self.keys.get(bound(where["eq"]), ()))
+
+    def stats(self) -> dict:
+        return super().stats() | {"values": len(self.keys)}
+
+
+class OrderedIndex(FieldIndex):
+    kind = "ordered"
+
+    def __init__(self, field: str) -> None:
+        super().__init__(field)
+        # (sort key, record key) pairs, so equal values come in key order
+        self.sorted = SortedKeys()
+
+    # sorting everything once beats inserting the records one by one
+    def build(self, items) -> None:
+        for key, value in items:
+            sk = self.extract(value)
+            if sk is not None:
+                self.values[key] = sk
+        self.sorted = SortedKeys((sk, key) for key, sk in self.values.items())
+
+    def insert(self, key: str, sk: tuple) -> None:
+        self.sorted.add((sk, key))
+
+    def remove(self, key: str, sk: tuple) -> None:
+        self.sorted.discard((sk, key))
+
+    def find(self, where: dict):
+        unknown = set(where) - {"eq", "gt", "gte", "lt", "lte"}
+        if unknown:
+            raise ValueError(f"Unsupported conditions: {', '.join(unknown)}")
+        if "eq" in where:
+            where = {"gte": where["eq"], "lte": where["eq"]}
+
+        lower = [(bound(where[op]), op) for op in ("gt", "gte") if op in where]
+        upper = [(bound(where[op]), op) for op in ("lt", "lte") if op in where]
+        ranks = {sk[0] for sk, _ in lower + upper}
+        if len(ranks) != 1:
+            raise ValueError(f"Range bounds must be of one type: {where}")
+        # a range never crosses into values of another type
+        rank = ranks.pop()
+        return self.scan(rank, lower, upper)
+
+    def scan(self, rank: int, lower: list, upper: list):
+        lo = max((sk for sk, _ in lower), default=(rank,))
+        for sk, key in self.sorted.irange((lo,)):
+            if sk[0] != rank or any(sk > b or (op == "lt" and sk == b) for b, op in upper):
+                return
+            if all(sk > b or (op == "gte" and sk == b) for b, op in lower):
+                yield key
+
+
+INDEXES = {"hash": HashIndex, "ordered": OrderedIndex}
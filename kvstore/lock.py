@@ -0,0 +1,42 @@
+from contextlib import contextmanager
+from threading import Condition, Lock
+
+
+# Many readers or one writer. Waiting writers go first, so a steady stream
+# of reads can not starve them, which also means a thread must not take the
+# read side again while it already holds it.
+class RWLock:
+    def __init__(self) -> None:
+        self.cond = Condition(Lock())
+        self.readers = 0
+        self.writer = False
+        self.waiting = 0
+
+    @contextmanager
+    def read(self):
+        with self.cond:
+            while self.writer or self.waiting:
+                self.cond.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.readers -= 1
+                if not self.readers:
+                    self.cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self.cond:
+            self.waiting += 1
+            while self.writer or self.readers:
+                self.cond.wait()
+            self.waiting -= 1
+            self.writer = True
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.writer = False
+                self.cond.notify_all()
@@ -0,0 +1,94 @@
+import re
+
+
+# A glob pattern (`*` any run, `?` any character, `[abc]`/`[a-z]`/`[!a]`
+# classes, `\` escapes the next character) split at its stars. Every segment
+# between two stars has a fixed width, so matching never backtracks across
+# segments: the first one is anchored at the start, the last one at the end,
+# and the ones in between are taken at their leftmost occurrence.
+class Glob:
+    def __init__(self, pattern: str) -> None:
+        self.pattern = pattern
+        segments = [[]]
+        prefix = []
+        literal = True
+        i = 0
+        while i < len(pattern):
+            c = pattern[i]
+            i += 1
+            match c:
+                case "*":
+                    literal = False
+                    if segments[-1] or len(segments) == 1:
+                        segments.append([])
+                    continue
+                case "?":
+                    token = "."
+                case "[":
+                    token, i = self.char_class(pattern, i)
+                case "\\" if i < len(pattern):
+                    token = re.escape(pattern[i])
+                    c = pattern[i]
+                    i += 1
+                case _:
+                    token = re.escape(c)
+
+            if literal and token == re.escape(c):
+                prefix.append(c)
+            else:
+                literal = False
+            segments[-1].append(token)
+
+        self.prefix = "".join(prefix)
+        self.star = len(segments) > 1
+        self.segments = [
+            (re.compile("".join(tokens), re.DOTALL), len(tokens)) for tokens in segments
+        ]
+
+    @staticmethod
+    def char_class(pattern: str, i: int) -> tuple[str, int]:
+        start = i
+        negate = i < len(pattern) and pattern[i] == "!"
+        if negate:
+            i += 1
+        members = []
+        # a `]` right after the opening bracket is a member, not the end
+        first = True
+        while i < len(pattern) and (first or pattern[i] != "]"):
+            first = False
+            lo = pattern[i]
+            if i + 2 < len(pattern) and pattern[i + 1] == "-" and pattern[i + 2] != "]":
+                hi = pattern[i + 2]
+                if lo <= hi:
+                    members.append(f"{re.escape(lo)}-{re.escape(hi)}")
+                i += 3
+            else:
+                members.append(re.escape(lo))
+                i += 1
+
+        if i == len(pattern):
+            # no closing bracket, so the `[` was meant literally
+            return re.escape("["), start
+        if not members:
+            return ("." if negate else "(?!)"), i + 1
+        return f"[{'^' if negate else ''}{''.join(members)}]", i + 1
+
+    def match(self, key: str) -> bool:
+        (first, width), *rest = self.segments
+        if not self.star:
+            return first.fullmatch(key) is not None
+        if first.match(key) is None:
+            return False
+
+        (last, tail), middle = rest[-1], rest[:-1]
+        pos = width
+        end = len(key) - tail
+        for segment, width in middle:
+            found = segment.search(key, pos, end)
+            if found is None:
+                return False
+            pos = found.end()
+        return end >= pos and last.match(key, end) is not None
+
+    def __repr__(self) -> str:
+        return f"Glob({self.pattern!r})"
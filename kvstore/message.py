@@ -2,85 +2,94 @@ from abc import ABC, abstractmethod
 from typing import Literal
 import json
 
-type msg_typ = Literal["null", "string", "number", "object"]
+type msg_typ = Literal["null", "string", "number", "boolean", "float", "bytes", "list", "object"]
 
 
 def serialize(typ: msg_typ, data: str | dict) -> bytes:
-    msg = b""
+    out = []
+    write(out, typ, data)
+    return "".join(out).encode("latin-1")
 
+
+# Pieces are collected as latin-1 text and encoded once at the end, so every
+# character stands for one byte: lengths count bytes and raw bytes round-trip.
+def write(out: list[str], typ: msg_typ, data: str | dict) -> None:
     match typ:
         case "null":
-            msg += "$-1\r\n".encode()
+            out.append("$-1\r\n")
         case "string":
-            msg += f"${len(data)}\r\n{data}\r\n".encode()
+            if not data.isascii():
+                data = data.encode().decode("latin-1")
+            out.append(f"${len(data)}\r\n{data}\r\n")
         case "number":
-            msg += f":{data}\r\n".encode()
+            out.append(f":{data}\r\n")
         case "boolean":
-            msg += f"|{'true' if data else 'false'}\r\n".encode()
+            out.append("|true\r\n" if data else "|false\r\n")
+        case "float":
+            out.append(f",{data!r}\r\n")
+        case "bytes":
+            out.append(f"!{len(data)}\r\n{data.decode('latin-1')}\r\n")
+        case "list":
+            out.append(f"^{len(data)}\r\n")
+            for value in data:
+                write(out, TYPES.get(type(value)) or type_(value), value)
         case "object":
-            msg += f"*{len(data)}\r\n".encode()
+            out.append(f"*{len(data)}\r\n")
             for key, value in data.items():
-                msg += serialize("string", key)
-                match value:
-                    case str():
-                        msg += serialize("string", value)
-                    case True | False:
-                        msg += serialize("boolean", value)
-                    case int():
-                        msg += serialize("number", value)
-                    case dict():
-                        msg += serialize("object", value)
-                    case None:
-                        msg += serialize("null", value)
-                    case _:
-                        raise ValueError(f"Unsupported value type: {type(value)}")
+                write(out, "string", key)
+                write(out, TYPES.get(type(value)) or type_(value), value)
         case _:
             raise ValueError(f"Unsupported type: {typ}")
-    return msg
 
 
 def deserialize(data: bytes) -> None | tuple[msg_typ, str, bytes]:
-    # check the first character to determine the type
     if len(data) == 0:
         return None
 
-    typ = data[0:1].decode()
-    match typ:
-        case "$":
-            # string
-            length_end = data.find(b"\r\n")
-            length = int(data[1:length_end])
-            if length == -1:
-                return ("null", None, data[length_end + 2 :])
-            end = length_end + 2 + length
-            return ("string", data[length_end + 2 : end].decode(), data[end + 2 :])
-        case ":":
-            # number
-            end = data.find(b"\r\n")
-            num = int(data[1:end].decode())
-            return ("number", num, data[end + 2 :])
-        case "|":
-            # boolean
-            end = data.find(b"\r\n")
-            boolean = data[1:end].decode() == "true"
-            return ("boolean", boolean, data[end + 2 :])
-        case "*":
-            # object
-            length_end = data.find(b"\r\n")
-            length = int(data[1:length_end])
-            end = length_end + 2
-            obj = {}
-            data = data[end:]
-
-            while length > 0:
-                typ, key, data = deserialize(data)
-                end += len(data)
-                typ, value, data = deserialize(data)
-                obj[key] = value
-                length -= 1
-            return ("object", obj, data)
-        case _:
-            raise ValueError(f"Unsupported type: {typ}")
+    typ, value, offset = read(data, 0)
+    return (typ, value, data[offset:])
+
+
+def read(data: bytes, offset: int) -> tuple[msg_typ, str | dict, int]:
+    # check the first character to determine the type
+    typ = data[offset]
+    end = data.index(b"\r\n", offset)
+    start = end + 2
+    if typ == 0x24:
+        # $: string
+        length = int(data[offset + 1 : end])
+        if length == -1:
+            return ("null", None, start)
+        end = start + length
+        return ("string", data[start:end].decode(), end + 2)
+    if typ == 0x2A:
+        # *: object
+        obj = {}
+        for _ in range(int(data[offset + 1 : end])):
+            _, key, start = read(data, start)
+            _, obj[key], start = read(data, start)
+        return ("object", obj, start)
+    if typ == 0x3A:
+        # :: number
+        return ("number", int(data[offset + 1 : end]), start)
+    if typ == 0x7C:
+        # |: boolean
+        return ("boolean", data[offset + 1 : end] == b"true", start)
+    if typ == 0x2C:
+        # ,: float
+        return ("float", float(data[offset + 1 : end]), start)
+    if typ == 0x5E:
+        # ^: list
+        lst = []
+        for _ in range(int(data[offset + 1 : end])):
+            _, value, start = read(data, start)
+            lst.append(value)
+        return ("list", lst, start)
+    if typ == 0x21:
+        # !: bytes
+        end = start + int(data[offset + 1 : end])
+        return ("bytes", bytes(data[start:end]), end + 2)
+    raise ValueError(f"Unsupported type: {chr(typ)}")
 
 
 class Message(ABC):
@@ -94,20 +103,22 @@ class Message(ABC):
         pass
 
     def serialize(self) -> bytes:
-        parts = self.parts()
-        msg = b""
-        for typ, data in parts:
-            msg += serialize(typ, data)
-        return msg
+        out = []
+        for typ, data in self.parts():
+            write(out, typ, data)
+        return "".join(out).encode("latin-1")
 
     @staticmethod
     def deserialize(data: bytes) -> "Message":
         parts = []
-        rest = data
-        while len(rest) > 0:
-            typ, data, rest = deserialize(rest)
-            parts.append((typ, data))
+        offset = 0
+        while offset < len(data):
+            typ, value, offset = read(data, offset)
+            parts.append((typ, value))
+        return Message.build(parts)
 
+    @staticmethod
+    def build(parts: list[tuple[msg_typ, str]]) -> "Message":
         message_classes = {
             "insert": Insert,
             "get": Get,
@@ -116,6 +127,17 @@ class Message(ABC):
             "startup": Startup,
             "stop": Stop,
             "shutdown": Shutdown,
+            "stats": Stats,
+            "snapshot": Snapshot,
+            "create_index": CreateIndex,
+            "query": Query,
+            "aggregate": Aggregate,
+            "delete_range": DeleteRange,
+            "count": Count,
+            "multi_get": MultiGet,
+            "multi_insert": MultiInsert,
+            "multi_delete": MultiDelete,
+            "transaction": Transaction,
         }
 
         cls = message_classes[parts[0][1]]
@@ -192,78 +214,239 @@ def type_(v: object) -> msg_typ:
         return "boolean"
     if isinstance(v, int):
         return "number"
+    if isinstance(v, float):
+        return "float"
+    if isinstance(v, bytes):
+        return "bytes"
+    if isinstance(v, list):
+        return "list"
     if isinstance(v, dict):
         return "object"
     raise ValueError(f"Unsupported type: {type(v)}")
 
+# exact-type lookup for the common cases, type_() handles subclasses
+TYPES = {
+    type(None): "null",
+    str: "string",
+    bool: "boolean",
+    int: "number",
+    float: "float",
+    bytes: "bytes",
+    list: "list",
+    dict: "object",
+}
+
+
+# Several messages travel in one pipelined body, or one TCP stream, framed as
+# `^n\r\n` followed by the n parts of each. Every answer is framed as the
+# list [status, body, version], the version being what HTTP sends as an ETag,
+# or null.
+def frame(msg: Message) -> bytes:
+    return f"^{len(msg.parts())}\r\n".encode() + msg.serialize()
+
+
+def unframe(data: bytes) -> list[Message]:
+    msgs = []
+    offset = 0
+    while offset < len(data):
+        end = data.index(b"\r\n", offset)
+        if data[offset] != 0x5E:
+            raise ValueError(f"Expected a frame, got {chr(data[offset])}")
+        parts = []
+        start = end + 2
+        for _ in range(int(data[offset + 1 : end])):
+            typ, value, start = read(data, start)
+            parts.append((typ, value))
+        msgs.append(Message.build(parts))
+        offset = start
+    return msgs
+
+
+def frame_response(status: int, body: bytes, version: int | None) -> bytes:
+    return serialize("list", [status, body, version])
+
+
+# Reads one framed answer off a blocking file, for clients.
+def read_response(f) -> tuple[int, bytes, int | None]:
+    if f.readline() != b"^3\r\n":
+        raise ValueError("Malformed response")
+    status = int(f.readline()[1:-2])
+    body = f.read(int(f.readline()[1:-2]) + 2)[:-2]
+    version = f.readline()
+    return status, body, int(version[1:-2]) if version.startswith(b":") else None
+
+
+# `if_version` is sent as a trailing number only when set. Insert and Delete
+# only apply while the key is at that version (0: while it does not exist),
+# a Get at the version the client already has answers without the value.
 class Insert(Message):
-    __match_args__ = ("k", "v")
+    __match_args__ = ("k", "v", "if_version")
 
     def __init__(self, **kwargs) -> None:
         self.k = kwargs["k"]
         self.v = kwargs["v"]
+        self.if_version = kwargs.get("if_version")
 
     def parts(self) -> list[tuple[msg_typ, str | int | bool | dict]]:
-        return [
+        parts = [
             ("string", "insert"),
             ("string", self.k),
             (type_(self.v), self.v),
         ]
+        if self.if_version is not None:
+            parts.append(("number", self.if_version))
+        return parts
 
     def from_parts(parts: list[tuple[msg_typ, str]]) -> "Insert":
         assert parts[0][1] == "insert"
-        return Insert(k=parts[1][1], v=parts[2][1])
+        if_version = parts[3][1] if len(parts) > 3 else None
+        return Insert(k=parts[1][1], v=parts[2][1], if_version=if_version)
 
 
 class Get(Message):
-    __match_args__ = ("k",)
+    __match_args__ = ("k", "if_version")
 
     def __init__(self, **kwargs) -> None:
         self.k = kwargs["k"]
+        self.if_version = kwargs.get("if_version")
 
     def parts(self) -> list[tuple[msg_typ, str]]:
-        return [
+        parts = [
             ("string", "get"),
             ("string", self.k),
         ]
+        if self.if_version is not None:
+            parts.append(("number", self.if_version))
+        return parts
 
     def from_parts(parts: list[tuple[msg_typ, str]]) -> "Get":
         assert parts[0][1] == "get"
-        return Get(k=parts[1][1])
+        if_version = parts[2][1] if len(parts) > 2 else None
+        return Get(k=parts[1][1], if_version=if_version)
 
 
 class Delete(Message):
-    __match_args__ = ("k",)
+    __match_args__ = ("k", "if_version")
 
     def __init__(self, **kwargs) -> None:
         self.k = kwargs["k"]
+        self.if_version = kwargs.get("if_version")
 
     def parts(self) -> list[tuple[msg_typ, str]]:
-        return [
+        parts = [
             ("string", "delete"),
             ("string", self.k),
         ]
+        if self.if_version is not None:
+            parts.append(("number", self.if_version))
+        return parts
 
     def from_parts(parts: list[tuple[msg_typ, str]]) -> "Delete":
         assert parts[0][1] == "delete"
-        return Delete(k=parts[1][1])
+        if_version = parts[2][1] if len(parts) > 2 else None
+        return Delete(k=parts[1][1], if_version=if_version)
 
 
+# Options ride along as a trailing object and are left off when empty, so
+# plain selects keep their old encoding. {"glob": True} matches `k` as a glob
+# pattern instead of a regex, "limit" and "cursor" page through the results,
+# "keys", "count" and "fields" (dotted paths) cut down what is sent back.
+# {"prefix": True} takes `k` literally as a key prefix.
 class Select(Message):
-    __match_args__ = ("k",)
+    __match_args__ = ("k", "opts")
 
     def __init__(self, **kwargs) -> None:
         self.k = kwargs["k"]
+        self.opts = kwargs.get("opts") or {}
 
-    def parts(self) -> list[tuple[msg_typ, str]]:
-        return [
+    def parts(self) -> list[tuple[msg_typ, str | dict]]:
+        parts = [
             ("string", "select"),
             ("string", self.k),
         ]
+        if self.opts:
+            parts.append(("object", self.opts))
+        return parts
 
-    def from_parts(parts: list[tuple[msg_typ, str]]) -> "Select":
+    def from_parts(parts: list[tuple[msg_typ, str | dict]]) -> "Select":
         assert parts[0][1] == "select"
-        return Select(k=parts[1][1])
+        opts = parts[2][1] if len(parts) > 2 else {}
+        return Select(k=parts[1][1], opts=opts)
+
+
+# Batch versions of the single-key messages, the keys (or [key, value] pairs)
+# travel as one list and are answered in order.
+class MultiInsert(Message):
+    __match_args__ = ("kvs",)
+
+    def __init__(self, **kwargs) -> None:
+        self.kvs = [[k, v] for k, v in kwargs["kvs"]]
+
+    def parts(self) -> list[tuple[msg_typ, list]]:
+        return [
+            ("string", "multi_insert"),
+            ("list", self.kvs),
+        ]
+
+    def from_parts(parts: list[tuple[msg_typ, list]]) -> "MultiInsert":
+        assert parts[0][1] == "multi_insert"
+        return MultiInsert(kvs=parts[1][1])
+
+
+class MultiGet(Message):
+    __match_args__ = ("ks",)
+
+    def __init__(self, **kwargs) -> None:
+        self.ks = list(kwargs["ks"])
+
+    def parts(self) -> list[tuple[msg_typ, list]]:
+        return [
+            ("string", "multi_get"),
+            ("list", self.ks),
+        ]
+
+    def from_parts(parts: list[tuple[msg_typ, list]]) -> "MultiGet":
+        assert parts[0][1] == "multi_get"
+        return MultiGet(ks=parts[1][1])
+
+
+class MultiDelete(Message):
+    __match_args__ = ("ks",)
+
+    def __init__(self, **kwargs) -> None:
+        self.ks = list(kwargs["ks"])
+
+    def parts(self) -> list[tuple[msg_typ, list]]:
+        return [
+            ("string", "multi_delete"),
+            ("list", self.ks),
+        ]
+
+    def from_parts(parts: list[tuple[msg_typ, list]]) -> "MultiDelete":
+        assert parts[0][1] == "multi_delete"
+        return MultiDelete(ks=parts[1][1])
+
+
+# Writes applied all or nothing: `ops` are ["insert", k, v] and ["delete", k],
+# `checks` are {"key": k} with "value": v, "version": n or "exists": bool and
+# all have to hold before anything is written.
+class Transaction(Message):
+    __match_args__ = ("ops", "checks")
+
+    def __init__(self, **kwargs) -> None:
+        self.ops = list(kwargs["ops"])
+        self.checks = list(kwargs.get("checks") or [])
+
+    def parts(self) -> list[tuple[msg_typ, list]]:
+        return [
+            ("string", "transaction"),
+            ("list", self.ops),
+            ("list", self.checks),
+        ]
+
+    def from_parts(parts: list[tuple[msg_typ, list]]) -> "Transaction":
+        assert parts[0][1] == "transaction"
+        return Transaction(ops=parts[1][1], checks=parts[2][1])
 
 
 class Startup(Message):
@@ -293,6 +476,139 @@ class Shutdown(Message):
         return Shutdown()
 
 
+class Stats(Message):
+    def parts(self) -> list[tuple[msg_typ, str]]:
+        return [("string", "stats")]
+
+    def from_parts(parts: list[tuple[msg_typ, str]]) -> "Stats":
+        assert parts[0][1] == "stats"
+        return Stats()
+
+
+class Snapshot(Message):
+    def parts(self) -> list[tuple[msg_typ, str]]:
+        return [("string", "snapshot")]
+
+    def from_parts(parts: list[tuple[msg_typ, str]]) -> "Snapshot":
+        assert parts[0][1] == "snapshot"
+        return Snapshot()
+
+
+class CreateIndex(Message):
+    __match_args__ = ("field", "kind")
+
+    def __init__(self, **kwargs) -> None:
+        self.field = kwargs["field"]
+        self.kind = kwargs.get("kind", "hash")
+
+    def parts(self) -> list[tuple[msg_typ, str]]:
+        return [
+            ("string", "create_index"),
+            ("string", self.field),
+            ("string", self.kind),
+        ]
+
+    def from_parts(parts: list[tuple[msg_typ, str]]) -> "CreateIndex":
+        assert parts[0][1] == "create_index"
+        return CreateIndex(field=parts[1][1], kind=parts[2][1])
+
+
+# Looks records up through the index on `field`, `where` is {"eq": v} or a
+# range made of "gt", "gte", "lt" and "lte".
+class Query(Message):
+    __match_args__ = ("field", "where")
+
+    def __init__(self, **kwargs) -> None:
+        self.field = kwargs["field"]
+        self.where = kwargs["where"]
+
+    def parts(self) -> list[tuple[msg_typ, str | dict]]:
+        return [
+            ("string", "query"),
+            ("string", self.field),
+            ("object", self.where),
+        ]
+
+    def from_parts(parts: list[tuple[msg_typ, str | dict]]) -> "Query":
+        assert parts[0][1] == "query"
+        return Query(field=parts[1][1], where=parts[2][1])
+
+
+# Aggregates the numbers at `field` over the records whose key matches `k`,
+# grouped by the value at `by`. Either field may be None, options are the
+# same "glob" and "prefix" switches as for Select.
+class Aggregate(Message):
+    __match_args__ = ("k", "field", "by", "opts")
+
+    def __init__(self, **kwargs) -> None:
+        self.k = kwargs["k"]
+        self.field = kwargs.get("field")
+        self.by = kwargs.get("by")
+        self.opts = kwargs.get("opts") or {}
+
+    def parts(self) -> list[tuple[msg_typ, str | dict | None]]:
+        parts = [
+            ("string", "aggregate"),
+            ("string", self.k),
+            (type_(self.field), self.field),
+            (type_(self.by), self.by),
+        ]
+        if self.opts:
+            parts.append(("object", self.opts))
+        return parts
+
+    def from_parts(parts: list[tuple[msg_typ, str | dict | None]]) -> "Aggregate":
+        assert parts[0][1] == "aggregate"
+        opts = parts[4][1] if len(parts) > 4 else {}
+        return Aggregate(k=parts[1][1], field=parts[2][1], by=parts[3][1], opts=opts)
+
+
+# Deletes every key matching `k` in one step, with the "glob" and "prefix"
+# options of Select.
+class DeleteRange(Message):
+    __match_args__ = ("k", "opts")
+
+    def __init__(self, **kwargs) -> None:
+        self.k = kwargs["k"]
+        self.opts = kwargs.get("opts") or {}
+
+    def parts(self) -> list[tuple[msg_typ, str | dict]]:
+        parts = [
+            ("string", "delete_range"),
+            ("string", self.k),
+        ]
+        if self.opts:
+            parts.append(("object", self.opts))
+        return parts
+
+    def from_parts(parts: list[tuple[msg_typ, str | dict]]) -> "DeleteRange":
+        assert parts[0][1] == "delete_range"
+        opts = parts[2][1] if len(parts) > 2 else {}
+        return DeleteRange(k=parts[1][1], opts=opts)
+
+
+class Count(Message):
+    __match_args__ = ("k", "opts")
+
+    def __init__(self, **kwargs) -> None:
+        self.k = kwargs["k"]
+        self.opts = kwargs.get("opts") or {}
+
+    def parts(self) -> list[tuple[msg_typ, str | dict]]:
+        parts = [
+            ("string", "count"),
+            ("string", self.k),
+        ]
+        if self.opts:
+            parts.append(("object", self.opts))
+        return parts
+
+    def from_parts(parts: list[tuple[msg_typ, str | dict]]) -> "Count":
+        assert parts[0][1] == "count"
+        opts = parts[2][1] if len(parts) > 2 else {}
+        return Count(k=parts[1][1], opts=opts)
+
+
 if __name__ == "__main__":
     msg = Insert(k="foo", v={"bar": 42})
     print(msg)
@@ -1,8 +1,96 @@
 import store
-import os
+import argparse
+from engine import FileEngine
+from wal import WALEngine
+from bitcask import BitcaskEngine
+from flusher import GroupCommit
+from codec import Codec
+from tcp import TCPStoreServer
+from functools import partial
+import shard
+import sys
+
+
+def open_store(args: argparse.Namespace, directory: str) -> store.Store:
+    codec = Codec(args.compress_threshold, typed=args.codec == "typed")
+    match args.engine:
+        case "files":
+            engine = FileEngine(
+                directory, args.fsync != "never", args.load_workers, progress=True, codec=codec
+            )
+        case "wal":
+            engine = WALEngine(
+                directory,
+                args.fsync,
+                args.fsync_interval,
+                args.snapshot_interval,
+                args.snapshot_retain,
+                codec,
+            )
+        case "bitcask":
+            engine = BitcaskEngine(
+                directory, args.fsync != "never", compact_interval=args.compact_interval, codec=codec
+            )
+
+    if args.durability is not None:
+        engine = GroupCommit(engine, args.durability, args.flush_interval, args.flush_bytes)
+
+    return store.Store(directory, engine, args.lazy, args.max_memory)
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dir", default=".store")
+    parser.add_argument("--engine", choices=["files", "wal", "bitcask"], default="files")
+    parser.add_argument("--fsync", choices=["always", "interval", "never"], default="always")
+    parser.add_argument("--fsync-interval", type=float, default=1.0)
+    parser.add_argument("--snapshot-interval", type=float)
+    parser.add_argument("--snapshot-retain", type=int, default=2)
+    parser.add_argument("--compact-interval", type=float, default=60.0)
+    parser.add_argument("--lazy", action="store_true")
+    parser.add_argument("--max-memory", type=int)
+    parser.add_argument("--load-workers", type=int, default=8)
+    parser.add_argument("--compress-threshold", type=int)
+    parser.add_argument("--codec", choices=["json", "typed"], default="json", help="typed keeps every value in the wire encoding")
+    parser.add_argument("--durability", choices=["sync", "group", "async"])
+    parser.add_argument("--flush-interval", type=float, default=0.01)
+    parser.add_argument("--flush-bytes", type=int, default=1 << 20)
+    parser.add_argument("--match-budget", type=int)
+    parser.add_argument("--workers", type=int, default=0, help="0 handles one request at a time")
+    parser.add_argument("--queue-size", type=int, default=64)
+    parser.add_argument("--protocol", choices=["http", "tcp"], default="http")
+    parser.add_argument("--idle-timeout", type=float, default=5.0)
+    parser.add_argument("--max-requests", type=int, default=1000, help="per kept-alive connection")
+    parser.add_argument("--shards", type=int, default=1, help="worker processes, each owning a part of the keys")
+    args = parser.parse_args(argv)
+
+    # the log keeps no per-key locations, so values can not be read one by one
+    if args.engine == "wal" and (args.lazy or args.max_memory is not None):
+        parser.error("--lazy and --max-memory need the files or bitcask engine")
+    if args.shards > 1 and args.protocol != "http":
+        parser.error("shards are only served over http")
+    return args
+
 
 if __name__ == '__main__':
-    httpd = store.StoreServer(('localhost', 8000), store.StoreHandler)
-    httpd.serve_forever()
+    args = parse_args()
+
+    if args.shards > 1:
+        shard.launch(
+            args.dir, args.shards, ('localhost', 8000), partial(open_store, args), args.match_budget, args.workers or 8
+        )
+        sys.exit()
 
-    
+    db = open_store(args, args.dir)
+    if args.protocol == "tcp":
+        server = TCPStoreServer(('localhost', 8000), db, args.match_budget, args.workers or 1)
+    elif args.workers > 0:
+        server = store.ThreadedStoreServer(
+            ('localhost', 8000), store.StoreHandler, db, args.match_budget, args.workers, args.queue_size,
+            args.idle_timeout, args.max_requests,
+        )
+    else:
+        server = store.StoreServer(
+            ('localhost', 8000), store.StoreHandler, db, args.match_budget, args.idle_timeout, args.max_requests
+        )
+    server.serve_forever()
@@ -0,0 +1,336 @@
+from concurrent.futures import ThreadPoolExecutor
+from message import Message, Insert, Get, Delete, Select, Startup, Stop, Shutdown, Stats, Snapshot, CreateIndex, Query, Aggregate, DeleteRange, Count
+from message import MultiGet, MultiInsert, MultiDelete, Transaction
+from store import StoreHandler, ThreadedStoreServer, respond_bytes, encode_cursor, decode_cursor
+from index import sort_key, resolve
+import heapq
+import http.client
+import json
+import multiprocessing
+import os
+import threading
+import time
+import zlib
+
+
+# Keys are hash-partitioned over the shards. The hash has to be stable
+# across processes and restarts, which Python's own str hash is not.
+def owner(k: str, shards: int) -> int:
+    return zlib.crc32(k.encode()) % shards
+
+
+# Serves one shard's store to the other shards, on a port of its own. It
+# never routes anything further, so shards calling each other can not
+# deadlock. A Shutdown sent to it also stops the shard's public server,
+# once the store is closed.
+class PeerServer(ThreadedStoreServer):
+    public = None
+
+    def stop(self) -> None:
+        super().stop()
+        if self.public is not None:
+            self.public.stopped.set()
+            # the public server may be waiting on this very shutdown
+            threading.Thread(target=self.public.shutdown, daemon=True).start()
+
+
+# The public front of one shard. Every shard listens on the same port with
+# SO_REUSEPORT and the kernel spreads connections over them, so any shard
+# may get any message. Single-key messages go to the shard that owns the
+# key, batches are split by owner, and scans fan out to every shard and are
+# merged in key order.
+class ShardServer(ThreadedStoreServer):
+    allow_reuse_port = True
+
+    def __init__(
+        self,
+        server_address,
+        handler_class,
+        peer: PeerServer,
+        shard: int,
+        peers: list[tuple[str, int]],
+        workers: int = 8,
+        queue_size: int = 64,
+        idle_timeout: float | None = 5.0,
+        max_requests: int | None = 1000,
+    ):
+        super().__init__(
+            server_address, handler_class, peer.store, peer.match_budget,
+            workers, queue_size, idle_timeout, max_requests,
+        )
+        # state that Startup, Stop and Stats act on lives with the peer
+        # server, this one only routes
+        self.peer = peer
+        peer.public = self
+        self.shard = shard
+        self.peers = peers
+        # http.client connections are not thread-safe, each thread keeps its own
+        self.local = threading.local()
+        self.fanout = ThreadPoolExecutor(len(peers))
+        # set once a Shutdown has closed the store, by either server
+        self.stopped = threading.Event()
+
+    def stop(self) -> None:
+        super().stop()
+        self.stopped.set()
+
+    # the peer server goes with the public one, whichever closed first
+    def server_close(self):
+        super().server_close()
+        self.peer.shutdown()
+        self.peer.server_close()
+
+    def owner(self, k: str) -> int:
+        return owner(k, len(self.peers))
+
+    # One message to one shard, answered with its status, body and version.
+    def call(self, shard: int, msg: Message, save: bool = True) -> tuple[int, bytes, int | None]:
+        if shard == self.shard:
+            return respond_bytes(self.peer, msg, save)
+
+        conns = self.local.__dict__.setdefault("conns", {})
+        payload = msg.serialize()
+        # a shard that is still starting up refuses connections for a while
+        for _ in range(50):
+            if shard not in conns:
+                conns[shard] = http.client.HTTPConnection(*self.peers[shard])
+            try:
+                conns[shard].request("POST", "/", payload)
+                resp = conns[shard].getresponse()
+                etag = resp.getheader("ETag")
+                try:
+                    body = resp.read()
+                except http.client.IncompleteRead:
+                    # the shard ran out of match budget halfway through a select
+                    conns.pop(shard).close()
+                    return 413, b"MATCH BUDGET EXCEEDED", None
+                return resp.status, body, int(etag.strip('"')) if etag is not None else None
+            except ConnectionRefusedError:
+                conns.pop(shard).close()
+                time.sleep(0.1)
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # a kept-alive connection the shard closed while it was idle
+                conns.pop(shard).close()
+        raise ConnectionRefusedError(f"Shard {shard} at {self.peers[shard]} is not answering")
+
+    # The same message to every shard at once, answers in shard order.
+    def broadcast(self, msg: Message, save: bool = True) -> list[tuple[int, bytes, int | None]]:
+        return list(self.fanout.map(lambda shard: self.call(shard, msg, save), range(len(self.peers))))
+
+    # Splits `items` by the shard owning key(item), runs make(items) on each
+    # shard, and puts the JSON list answers back in the original order.
+    def split(self, items: list, key, make, save: bool) -> tuple[int, bytes, int | None]:
+        groups = {}
+        for i, item in enumerate(items):
+            groups.setdefault(self.owner(key(item)), []).append(i)
+        shards = list(groups)
+        answers = self.fanout.map(
+            lambda shard: self.call(shard, make([items[i] for i in groups[shard]]), save), shards
+        )
+        results = [None] * len(items)
+        for shard, (status, body, _) in zip(shards, answers):
+            if status != 200:
+                return status, body, None
+            for i, v in zip(groups[shard], json.loads(body)):
+                results[i] = v
+        return 200, json.dumps(results).encode(), None
+
+    def respond(self, msg: Message, save: bool = True) -> tuple[int, bytes, int | None]:
+        match msg:
+            case Insert() | Get() | Delete():
+                return self.call(self.owner(msg.k), msg, save)
+            case MultiGet(ks):
+                return self.split(ks, lambda k: k, lambda ks: MultiGet(ks=ks), save)
+            case MultiInsert(kvs):
+                return self.split(kvs, lambda kv: kv[0], lambda kvs: MultiInsert(kvs=kvs), save)
+            case MultiDelete(ks):
+                return self.split(ks, lambda k: k, lambda ks: MultiDelete(ks=ks), save)
+            case Transaction(ops, checks):
+                # all or nothing only holds within one shard
+                keys = [op[1] for op in ops if len(op) > 1 and isinstance(op[1], str)]
+                keys += [c["key"] for c in checks if isinstance(c, dict) and isinstance(c.get("key"), str)]
+                shards = {self.owner(k) for k in keys}
+                if len(shards) > 1:
+                    return 400, b"Transaction keys span shards", None
+                return self.call(shards.pop() if shards else self.shard, msg, save)
+            case Select(k, opts):
+                return merge_select(self.broadcast(msg, save), opts)
+            case Count() | DeleteRange():
+                return merge_totals(self.broadcast(msg, save))
+            case Aggregate(k, field, by, opts):
+                return merge_aggregates(self.broadcast(msg, save), by is not None)
+            case Query(field, where):
+                return merge_query(self.broadcast(msg, save), field)
+            case Stats():
+                return merge_all(self.broadcast(msg, save), lambda bodies: {"shards": bodies})
+            case Startup() | Stop() | Snapshot() | CreateIndex():
+                return merge_all(self.broadcast(msg, save), None)
+            case Shutdown():
+                # every other shard first, this one stops once the answer is out
+                for shard in range(len(self.peers)):
+                    if shard != self.shard:
+                        self.call(shard, msg, save)
+                return self.call(self.shard, msg, save)
+            case _:
+                return self.call(self.shard, msg, save)
+
+
+# The first failure, if any shard failed.
+def failure(answers: list) -> tuple | None:
+    for status, body, _ in answers:
+        if status != 200:
+            return status, body, None
+    return None
+
+
+# Every shard's JSON answer combined by `combine`, or just the first answer
+# when all of them are the same acknowledgement.
+def merge_all(answers: list, combine) -> tuple[int, bytes, int | None]:
+    failed = failure(answers)
+    if failed is not None:
+        return failed
+    if combine is None:
+        return answers[0]
+    return 200, json.dumps(combine([json.loads(body) for _, body, _ in answers])).encode(), None
+
+
+def merge_totals(answers: list) -> tuple[int, bytes, int | None]:
+    failed = failure(answers)
+    if failed is not None:
+        return failed
+    total = {}
+    for _, body, _ in answers:
+        for name, n in json.loads(body).items():
+            total[name] = total.get(name, 0) + n
+    return 200, json.dumps(total).encode(), None
+
+
+def row_key(row) -> str:
+    return row if isinstance(row, str) else next(iter(row))
+
+
+# Plain selects are merged in key order. Paged ones are cut at the lowest
+# key any shard stopped at, since a shard that stopped early (at its limit
+# or out of budget) has not looked past it, and the merged page resumes
+# from there. Cursors are keys, so they mean the same on every shard.
+def merge_select(answers: list, opts: dict) -> tuple[int, bytes, int | None]:
+    failed = failure(answers)
+    if failed is not None:
+        return failed
+    pages = [json.loads(body) for _, body, _ in answers]
+    if opts.get("count"):
+        return 200, json.dumps({"count": sum(page["count"] for page in pages)}).encode(), None
+    if not (opts.get("limit") is not None or "cursor" in opts):
+        rows = heapq.merge(*pages, key=row_key)
+        return 200, json.dumps(list(rows)).encode(), None
+
+    stops = [decode_cursor(page["cursor"]) for page in pages if page["cursor"] is not None]
+    frontier = min(stops, default=None)
+    rows = heapq.merge(*(page["items"] for page in pages), key=row_key)
+    limit = opts.get("limit")
+    items = []
+    cursor = None
+    for row in rows:
+        if frontier is not None and row_key(row) > frontier:
+            break
+        if len(items) == limit:
+            cursor = row_key(items[-1])
+            break
+        items.append(row)
+    if cursor is None:
+        cursor = frontier
+    return 200, json.dumps({"items": items, "cursor": encode_cursor(cursor) if cursor is not None else None}).encode(), None
+
+
+# Groups, ungrouped results alike, are merged on their counts, sums and
+# extremes, and the average is worked out again from those.
+def merge_aggregates(answers: list, grouped: bool) -> tuple[int, bytes, int | None]:
+    failed = failure(answers)
+    if failed is not None:
+        return failed
+    results = [json.loads(body) for _, body, _ in answers]
+    if not grouped:
+        return 200, json.dumps(combine_accumulators(results)).encode(), None
+
+    groups = {}
+    for result in results:
+        for acc in result["groups"]:
+            group = acc.pop("group")
+            groups.setdefault(sort_key(group) or (-1,), (group, []))[1].append(acc)
+    merged = [
+        {"group": group} | combine_accumulators(accs)
+        for _, (group, accs) in sorted(groups.items(), key=lambda g: g[0])
+    ]
+    return 200, json.dumps({"groups": merged}).encode(), None
+
+
+def combine_accumulators(accs: list[dict]) -> dict:
+    result = {"count": sum(acc["count"] for acc in accs)}
+    accs = [acc for acc in accs if "sum" in acc]
+    if accs:
+        result["values"] = sum(acc["values"] for acc in accs)
+        result["sum"] = sum(acc["sum"] for acc in accs)
+        result["min"] = min(acc["min"] for acc in accs)
+        result["max"] = max(acc["max"] for acc in accs)
+        result["avg"] = result["sum"] / result["values"]
+    return result
+
+
+# Query answers come in index order, by the indexed value and then the key.
+def merge_query(answers: list, field: str) -> tuple[int, bytes, int | None]:
+    failed = failure(answers)
+    if failed is not None:
+        return failed
+    path = field.split(".")
+    rows = [row for _, body, _ in answers for row in json.loads(body)]
+    rows.sort(key=lambda row: (sort_key(resolve(next(iter(row.values())), path)), row_key(row)))
+    return 200, json.dumps(rows).encode(), None
+
+
+# Runs one shard: its store under `{directory}/shard-{i}`, a peer server on
+# port + 1 + i for the other shards, and the public server on the shared
+# port. `open_store(directory)` builds the store, after the fork.
+def worker(shard: int, shards: int, directory: str, address: tuple[str, int], open_store, match_budget, workers: int) -> None:
+    host, port = address
+    peers = [(host, port + 1 + i) for i in range(shards)]
+    store = open_store(f"{directory}/shard-{shard}")
+    # every other shard may hold a connection from each of its public
+    # workers and each of its fan-out threads
+    peer = PeerServer(peers[shard], StoreHandler, store, match_budget, shards * (workers + shards))
+    threading.Thread(target=peer.serve_forever, daemon=True).start()
+    public = ShardServer(address, StoreHandler, peer, shard, peers, workers)
+    print(f"shard {shard}/{shards} serving {store.stats()['keys']} keys on port {port}")
+    # a Shutdown closes the store on its way out, the process must not end
+    # before it has
+    public.serve_forever()
+    public.stopped.wait()
+    public.server_close()
+
+
+# Forks one worker process per shard and waits for all of them. A directory
+# keeps its shard count, since keys would land on other shards with another.
+def launch(directory: str, shards: int, address: tuple[str, int], open_store, match_budget=None, workers: int = 8) -> None:
+    os.makedirs(directory, exist_ok=True)
+    path = f"{directory}/shards"
+    if os.path.exists(path):
+        with open(path) as f:
+            existing = int(f.read())
+        if existing != shards:
+            raise ValueError(f"{directory} holds {existing} shards, not {shards}")
+    else:
+        with open(path, "w") as f:
+            f.write(str(shards))
+
+    context = multiprocessing.get_context("fork")
+    processes = [
+        context.Process(target=worker, args=(shard, shards, directory, address, open_store, match_budget, workers))
+        for shard in range(shards)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
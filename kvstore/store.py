@@ -1,143 +1,1050 @@
-import os
 import http.server
+import base64
+import itertools
 import json
+import os
+import queue
 import re
-from message import Message, Insert, Get, Delete, Select, Startup, Stop, Shutdown
+import select
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterator
+from message import Message, Insert, Get, Delete, Select, Startup, Stop, Shutdown, Stats, Snapshot, CreateIndex, Query, Aggregate, DeleteRange, Count
+from message import MultiGet, MultiInsert, MultiDelete, Transaction, unframe, frame_response
+from engine import Engine, FileEngine, CLOCK
+from codec import encode
+from index import SortedKeys, FieldIndex, INDEXES, literal_prefix, sort_key, resolve
+from matcher import Glob
+from lock import RWLock
 
 
 class StoreServer(http.server.HTTPServer):
-    def __init__(self, server_address, handler_class):
+    def __init__(
+        self,
+        server_address,
+        handler_class,
+        store: "Store | None" = None,
+        match_budget: int | None = None,
+        idle_timeout: float | None = 5.0,
+        max_requests: int | None = 1000,
+    ):
         super().__init__(server_address, handler_class)
-        self.store = Store(".store")
+        self.store = store if store is not None else Store(".store")
+        # the most keys a single select may test before it is refused
+        self.match_budget = match_budget
+        # how long a kept-alive connection may sit between requests, and how
+        # many requests it may send before it is closed
+        self.idle_timeout = idle_timeout
+        self.max_requests = max_requests
         self.running = True
+        self.first_request_ms = None
+
+    # answers one message, see respond
+    def respond(self, msg: Message, save: bool = True) -> tuple[int, bytes | Iterator[bytes], int | None]:
+        return respond(self, msg, save)
+
+    # A single thread can only serve one connection, so it lets a kept-alive
+    # one go as soon as another client is waiting to be accepted, both after
+    # a request and while it waits for the next one.
+    def busy(self) -> bool:
+        return bool(select.select([self.socket], [], [], 0)[0])
+
+    # whether the next request arrives on `connection` within `idle_timeout`
+    def wait(self, connection) -> bool:
+        readable, _, _ = select.select([connection, self.socket], [], [], self.idle_timeout)
+        return connection in readable
+
+    # Runs a Shutdown from a handler thread: stops the accept loop, closes
+    # the socket and then the store.
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+        self.store.close()
+
+
+# Hands accepted connections to a fixed pool of worker threads through a
+# bounded queue. Once the queue is full the accept loop waits, so a burst
+# of clients backs up in the listen backlog rather than in memory.
+class ThreadedStoreServer(StoreServer):
+    def __init__(
+        self,
+        server_address,
+        handler_class,
+        store: "Store | None" = None,
+        match_budget: int | None = None,
+        workers: int = 8,
+        queue_size: int = 64,
+        idle_timeout: float | None = 5.0,
+        max_requests: int | None = 1000,
+    ):
+        super().__init__(server_address, handler_class, store, match_budget, idle_timeout, max_requests)
+        self.requests = queue.Queue(queue_size)
+        self.closing = threading.Lock()
+        self.closed = False
+        self.workers = [threading.Thread(target=self.work, daemon=True) for _ in range(workers)]
+        for worker in self.workers:
+            worker.start()
 
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+    def work(self) -> None:
+        while True:
+            item = self.requests.get()
+            if item is None:
+                # pass the stop on to the next idle worker
+                try:
+                    self.requests.put_nowait(None)
+                except queue.Full:
+                    pass
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    # every worker holds a connection and more are queued
+    def busy(self) -> bool:
+        return not self.requests.empty()
+
+    # a worker waits on its own connection, the socket timeout ends it
+    def wait(self, connection) -> bool:
+        return True
+
+    # Closing twice is harmless and never blocks. The stop goes into the
+    # queue only if it has room, workers left waiting on a full queue are
+    # daemons and end with the process.
+    def server_close(self):
+        with self.closing:
+            if self.closed:
+                return
+            self.closed = True
+        super().server_close()
+        try:
+            self.requests.put_nowait(None)
+        except queue.Full:
+            pass
+
+
+# Connections are kept alive between requests, so every response carries a
+# Content-Length or is chunked. A connection is closed when the client asks
+# for it, after `max_requests` requests, after `idle_timeout` seconds without
+# one, or when other clients are waiting for the server, even while idle.
 class StoreHandler(http.server.SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in separate writes, which Nagle's algorithm
+    # would hold back until the client acknowledges the first
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        # read by StreamRequestHandler.setup, a timeout ends the connection
+        self.timeout = self.server.idle_timeout
+        self.handled = 0
+        self.served = False
+        super().setup()
+
+    # The first request is already on its way, the server decides how long
+    # to wait for the ones after it.
+    def handle_one_request(self):
+        if self.served and not self.buffered() and not self.server.wait(self.connection):
+            self.close_connection = True
+            return
+        self.served = True
+        super().handle_one_request()
+
+    # a request sent right behind the last one may already sit in rfile,
+    # where select can not see it
+    def buffered(self) -> bool:
+        self.connection.setblocking(False)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return True
+        finally:
+            self.connection.settimeout(self.timeout)
+
     def do_POST(self):
         content_length = int(self.headers["Content-Length"])
         msg = self.rfile.read(content_length)
+        self.handled += 1
+        if self.path == "/pipeline":
+            self.pipeline(msg)
+            return
         msg = Message.deserialize(msg)
 
-        if not self.server.running and not isinstance(msg, Startup):
-            self.send_response(503)
+        last = (
+            isinstance(msg, Shutdown)
+            or self.handled == self.server.max_requests
+            or self.server.busy()
+        )
+        status, body, version = self.server.respond(msg)
+        if not isinstance(body, bytes) and self.request_version != "HTTP/1.1":
+            # chunked bodies are HTTP/1.1 only, older clients get it whole
+            status, body, version = collect(status, body, version)
+        if isinstance(body, bytes):
+            self.send_response(status)
+            if version is not None:
+                self.send_header("ETag", etag(version))
+            self.send_header("Content-Length", str(len(body)))
+            if last:
+                self.send_header("Connection", "close")
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_chunked(body, last)
+
+        if status == 200 and isinstance(msg, Shutdown):
+            self.server.stop()
+
+    # A body of framed messages (see message.frame) runs in order and is
+    # answered with one framed answer per message, all after a single save.
+    # Messages after a Shutdown are not run and answered with a 503.
+    def pipeline(self, body: bytes) -> None:
+        try:
+            msgs = unframe(body)
+        except (KeyError, ValueError, IndexError, TypeError):
+            self.send_response(400)
+            self.send_header("Content-Length", "11")
             self.end_headers()
-            self.wfile.write(b"SERVER IS NOT RUNNING")
+            self.wfile.write(b"BAD REQUEST")
             return
 
-        match msg:
-            case Insert(k, v):
-                print(f".insert {k} {v}")
-                v = self.server.store.insert(k, v)
-                self.send_response(200)
-                self.end_headers()
-                if v is not None:
-                    self.wfile.write(str(v).encode())
-                else:
-                    self.wfile.write(b"OK")
-            case Get(k):
-                print(f".get {k}")
-                v = self.server.store.get(k)
-                if v is not None:
-                    self.send_response(200)
-                    self.end_headers()
-                    self.wfile.write(str(v).encode())
+        print(f".pipeline {len(msgs)} messages")
+        answers = []
+        shutdown = False
+        for msg in msgs:
+            if shutdown:
+                answers.append(frame_response(503, b"SERVER IS NOT RUNNING", None))
+                continue
+            answers.append(respond_framed(self.server, msg, save=False))
+            shutdown = isinstance(msg, Shutdown) and self.server.running
+        if any(isinstance(msg, MUTATIONS) for msg in msgs):
+            self.server.store.save()
+
+        body = b"".join(answers)
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        if shutdown or self.handled == self.server.max_requests or self.server.busy():
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(body)
+
+        if shutdown:
+            self.server.stop()
+
+    def send_chunked(self, chunks, last: bool) -> None:
+        self.send_response(200)
+        self.send_header("Transfer-Encoding", "chunked")
+        if last:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        try:
+            for chunk in chunks:
+                self.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+        except BudgetExceeded:
+            # too late for a status, a missing last chunk and a closed
+            # connection tell the client the body is incomplete
+            self.close_connection = True
+            return
+        self.wfile.write(b"0\r\n\r\n")
+
+
+# Answers one message for any front end, as a status, a body and the version
+# to send as an ETag, if any. Server state (`store`, `match_budget`,
+# `running`, `first_request_ms`) lives on `server`. A select body is an
+# iterator of chunks that may still raise BudgetExceeded, every other body
+# is bytes. Shutting down is left to the front end once the answer is out.
+# Without `save` writes are not persisted yet, the caller saves once for a
+# whole pipeline before answering any of it.
+def respond(server, msg: Message, save: bool = True) -> tuple[int, bytes | Iterator[bytes], int | None]:
+    if server.first_request_ms is None:
+        server.first_request_ms = 1000 * (time.perf_counter() - server.store.opened)
+        print(f"first request {server.first_request_ms:.1f}ms after opening the store")
+
+    if not server.running and not isinstance(msg, Startup):
+        return 503, b"SERVER IS NOT RUNNING", None
+
+    store = server.store
+    match msg:
+        case Insert(k, v, if_version):
+            print(f".insert {k} {v}")
+            try:
+                v, version = store.insert_versioned(k, v, if_version)
+            except Conflict as e:
+                return 412, b"VERSION MISMATCH", e.version
+            except ValueError as e:
+                return 400, str(e).encode(), None
+            if save:
+                store.save()
+            return 200, str(v).encode() if v is not None else b"OK", version
+        case Get(k, if_version):
+            print(f".get {k}")
+            v, version = store.get_versioned(k)
+            if v is not None and version == if_version:
+                return 304, b"", version
+            elif v is not None:
+                return 200, str(v).encode(), version
+            return 404, b"NOT FOUND", None
+        case Delete(k, if_version):
+            print(f".delete {k}")
+            try:
+                v = store.delete(k, if_version)
+            except Conflict as e:
+                return 412, b"VERSION MISMATCH", e.version
+            if save:
+                store.save()
+            if v is not None:
+                return 200, str(v).encode(), None
+            return 404, b"NOT FOUND", None
+        case MultiInsert(kvs):
+            print(f".insertmany {len(kvs)} keys")
+            try:
+                vs = store.insert_many(kvs)
+            except ValueError as e:
+                return 400, str(e).encode(), None
+            if save:
+                store.save()
+            return 200, dumps(vs).encode(), None
+        case MultiGet(ks):
+            print(f".getmany {len(ks)} keys")
+            return 200, dumps(store.get_many(ks)).encode(), None
+        case MultiDelete(ks):
+            print(f".deletemany {len(ks)} keys")
+            vs = store.delete_many(ks)
+            if save:
+                store.save()
+            return 200, dumps(vs).encode(), None
+        case Transaction(ops, checks):
+            print(f".transaction {len(ops)} ops {len(checks)} checks")
+            try:
+                vs = store.transact(ops, checks)
+            except Conflict as e:
+                return 409, dumps({"conflict": e.key}).encode(), None
+            except ValueError as e:
+                return 400, str(e).encode(), None
+            if save:
+                store.save()
+            return 200, dumps(vs).encode(), None
+        case Select(k, opts):
+            print(f".select {k} {opts}" if opts else f".select {k}")
+            try:
+                k, glob = pattern(k, opts)
+                limit = opts.get("limit")
+                if limit is not None and limit < 1:
+                    raise ValueError(f"Invalid limit: {limit}")
+                after = decode_cursor(opts["cursor"]) if opts.get("cursor") else None
+                fields = opts.get("fields")
+                # keys-only and count-only selects never touch the values
+                values = not opts.get("keys") and not opts.get("count")
+                rows = store.scan(k, glob=glob, budget=server.match_budget, after=after, values=values)
+                if opts.get("count"):
+                    count = sum(1 for _ in rows)
+                    return 200, dumps({"count": count}).encode(), None
+                if not values:
+                    render = lambda key, v: dumps(key)
+                elif fields is not None:
+                    render = lambda key, v: dumps({key: project(v, fields)})
                 else:
-                    self.send_response(404)
-                    self.end_headers()
-                    self.wfile.write(b"NOT FOUND")
-            case Delete(k):
-                print(f".delete {k}")
-                v = self.server.store.delete(k)
-                if v is not None:
-                    self.send_response(200)
-                    self.end_headers()
-                    self.wfile.write(str(v).encode())
+                    render = lambda key, v: dumps({key: v})
+                paged = limit is not None or "cursor" in opts
+                chunks = select_chunks(rows, render, paged, limit)
+                # the first batch is built before answering, so an early
+                # failure can still get a proper status
+                first = next(chunks)
+            except BudgetExceeded:
+                return 413, b"MATCH BUDGET EXCEEDED", None
+            except (ValueError, re.error) as e:
+                return 400, str(e).encode(), None
+            return 200, itertools.chain([first], chunks), None
+        case CreateIndex(field, kind):
+            print(f".create_index {field} {kind}")
+            try:
+                store.create_index(field, kind)
+            except ValueError as e:
+                return 400, str(e).encode(), None
+            return 200, b"INDEX CREATED", None
+        case Query(field, where):
+            print(f".query {field} {where}")
+            try:
+                vs = store.query(field, where)
+            except ValueError as e:
+                return 400, str(e).encode(), None
+            return 200, dumps(vs).encode(), None
+        case Aggregate(k, field, by, opts):
+            print(f".aggregate {k} {field} {by}")
+            try:
+                k, glob = pattern(k, opts)
+                result = store.aggregate(k, field, by, glob=glob, budget=server.match_budget)
+            except BudgetExceeded:
+                return 413, b"MATCH BUDGET EXCEEDED", None
+            except (ValueError, re.error) as e:
+                return 400, str(e).encode(), None
+            return 200, dumps(result).encode(), None
+        case DeleteRange(k, opts) | Count(k, opts):
+            delete = isinstance(msg, DeleteRange)
+            print(f".{'delete_range' if delete else 'count'} {k} {opts}")
+            try:
+                k, glob = pattern(k, opts)
+                if delete:
+                    result = {"deleted": store.delete_range(k, glob, server.match_budget)}
+                    if save:
+                        store.save()
                 else:
-                    self.send_response(404)
-                    self.end_headers()
-                    self.wfile.write(b"NOT FOUND")
-            case Select(k):
-                print(f".select {k}")
-                vs = self.server.store.select(k)
-                vs = json.dumps(vs)
-                self.send_response(200)
-                self.end_headers()
-                self.wfile.write(vs.encode())
-            case Startup():
-                self.server.running = True
-                self.send_response(200)
-                self.end_headers()
-                self.wfile.write(b"SERVER STARTED")
-            case Stop():
-                self.server.running = False
-                self.send_response(200)
-                self.end_headers()
-                self.wfile.write(b"SERVER STOPPED")
-            case Shutdown():
-                self.send_response(200)
-                self.end_headers()
-                self.wfile.write(b"SERVER SHUTDOWN")
-                self.server.shutdown()
-                self.server.server_close()
-            case _:
-                self.send_response(400)
-                self.end_headers()
-                self.wfile.write(b"BAD REQUEST")
-
-        self.server.store.save()
+                    result = {"count": store.count(k, glob, server.match_budget)}
+            except BudgetExceeded:
+                return 413, b"MATCH BUDGET EXCEEDED", None
+            except (ValueError, re.error) as e:
+                return 400, str(e).encode(), None
+            return 200, dumps(result).encode(), None
+        case Startup():
+            server.running = True
+            return 200, b"SERVER STARTED", None
+        case Stop():
+            server.running = False
+            return 200, b"SERVER STOPPED", None
+        case Stats():
+            stats = store.stats()
+            stats["first_request_ms"] = server.first_request_ms
+            return 200, dumps(stats).encode(), None
+        case Snapshot():
+            try:
+                store.snapshot()
+            except NotImplementedError as e:
+                return 501, str(e).encode(), None
+            return 200, b"SNAPSHOT WRITTEN", None
+        case Shutdown():
+            return 200, b"SERVER SHUTDOWN", None
+        case _:
+            return 400, b"BAD REQUEST", None
+
+
+# Answers with the whole body at once, through the server's own respond.
+# Select bodies are collected in full, so running out of match budget
+# halfway through is still a 413.
+def respond_bytes(server, msg: Message, save: bool = True) -> tuple[int, bytes, int | None]:
+    return collect(*server.respond(msg, save))
+
+
+def collect(status: int, body: bytes | Iterator[bytes], version: int | None) -> tuple[int, bytes, int | None]:
+    if not isinstance(body, bytes):
+        try:
+            body = b"".join(body)
+        except BudgetExceeded:
+            return 413, b"MATCH BUDGET EXCEEDED", None
+    return status, body, version
+
+
+# A framed answer can not be cut short, see respond_bytes.
+def respond_framed(server, msg: Message, save: bool = True) -> bytes:
+    return frame_response(*respond_bytes(server, msg, save))
+
+
+# messages that need a save before they are answered
+MUTATIONS = (Insert, Delete, MultiInsert, MultiDelete, Transaction, DeleteRange)
+
+
+# Select bodies are written in batches of rows, a plain select as a JSON
+# list and a paged one as {"items": [...], "cursor": ...} where a null
+# cursor means there is nothing left. One row past the limit is read to
+# tell the two apart. A paged select that runs out of match budget ends
+# the page early with a cursor to resume from.
+def select_chunks(rows, render, paged: bool, limit: int | None):
+    out = [b'{"items": [' if paged else b"["]
+    sep = b""
+    count = 0
+    last = cursor = None
+    try:
+        for key, v in rows:
+            if count == limit:
+                cursor = last
+                break
+            out.append(sep + render(key, v).encode())
+            sep = b", "
+            count += 1
+            last = key
+            if len(out) >= SELECT_BATCH:
+                yield b"".join(out)
+                out = []
+    except BudgetExceeded as e:
+        if not paged or e.key is None:
+            raise
+        cursor = e.key
+
+    if paged:
+        cursor = encode_cursor(cursor) if cursor is not None else None
+        out.append(b'], "cursor": ' + json.dumps(cursor).encode() + b"}")
+    else:
+        out.append(b"]")
+    yield b"".join(out)
+
+
+SELECT_BATCH = 256
+SCAN_CHUNK = 1024
+
+
+# The literal prefix every match has to start with, and a match function.
+def compile_pattern(k: str, glob: bool) -> tuple:
+    if glob:
+        matcher = Glob(k)
+        return matcher.prefix, matcher.match
+    return literal_prefix(k), re.compile(k).match
+
+
+# Versions go out as HTTP entity tags, 0 standing for a missing key.
+def etag(version: int | None) -> str:
+    return f'"{version or 0}"'
+
+
+# Options come straight off the wire, so their types are checked before
+# anything uses them and a bad one is a ValueError like any bad pattern.
+def check_opts(k: object, opts: object) -> None:
+    if not isinstance(k, str):
+        raise ValueError(f"Invalid pattern: {k!r}")
+    if not isinstance(opts, dict):
+        raise ValueError(f"Invalid options: {opts!r}")
+    limit = opts.get("limit")
+    if limit is not None and (not isinstance(limit, int) or isinstance(limit, bool)):
+        raise ValueError(f"Invalid limit: {limit!r}")
+    cursor = opts.get("cursor")
+    if cursor is not None and not isinstance(cursor, str):
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+    fields = opts.get("fields")
+    if fields is not None and not (isinstance(fields, list) and all(isinstance(f, str) for f in fields)):
+        raise ValueError(f"Invalid fields: {fields!r}")
+
+
+# The regex or glob to match keys with, from a key and its message options.
+def pattern(k: str, opts: dict) -> tuple[str, bool]:
+    check_opts(k, opts)
+    if opts.get("prefix"):
+        return re.escape(k), False
+    return k, opts.get("glob", False)
+
+
+# Keeps only the given dotted paths of a value, nested as in the original.
+# Paths that do not resolve to anything are left out. Subtrees are shared
+# with the stored value, so only dicts built here are ever written to.
+def project(v: object, fields: list[str]) -> dict:
+    result = {}
+    built = {id(result)}
+    for field in fields:
+        path = field.split(".")
+        node = v
+        for part in path:
+            if not isinstance(node, dict) or part not in node:
+                break
+            node = node[part]
+        else:
+            into = result
+            for part in path[:-1]:
+                if part not in into:
+                    into[part] = {}
+                    built.add(id(into[part]))
+                elif id(into[part]) not in built:
+                    # an earlier, shorter path already took the whole subtree
+                    break
+                into = into[part]
+            else:
+                into[path[-1]] = node
+    return result
+
+
+# JSON has no bytes, so answers carry bytes values as {"$bytes": base64}.
+def dumps(v: object) -> str:
+    return json.dumps(v, default=encode_bytes)
+
+
+def encode_bytes(v: object) -> dict:
+    if isinstance(v, bytes):
+        return {"$bytes": base64.b64encode(v).decode()}
+    raise TypeError(f"Object of type {type(v).__name__} is not JSON serializable")
+
+
+# Cursors are the last key a page got to, opaque to clients.
+def encode_cursor(key: str) -> str:
+    return base64.urlsafe_b64encode(key.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> str:
+    return base64.urlsafe_b64decode(cursor.encode()).decode()
+
+
+class BudgetExceeded(Exception):
+    def __init__(self, key: str | None) -> None:
+        super().__init__(f"match budget exceeded after key {key!r}")
+        # the last key tested, a scan can resume right after it
+        self.key = key
+
+
+class Conflict(Exception):
+    def __init__(self, key: str, version: int | None = None) -> None:
+        super().__init__(f"precondition on key {key!r} does not hold")
+        self.key = key
+        # the version the key was at when the precondition was checked
+        self.version = version
+
+
+# Placeholder for values that a lazily loaded store has not read yet.
+UNLOADED = object()
+
+# How far, in microseconds, the clock's lease on disk runs ahead, so it is
+# written about once a minute under a steady stream of writes.
+CLOCK_LEASE = 60_000_000
+
+
+# What engines get in place of the items. Copying takes the store's read
+# lock, so a snapshot never holds half of a batch or a transaction.
+class Items:
+    def __init__(self, copy) -> None:
+        self.copy = copy
 
 
 class Store:
-    def __init__(self, name: str) -> None:
+    def __init__(
+        self,
+        name: str,
+        engine: Engine | None = None,
+        lazy: bool = False,
+        max_memory: int | None = None,
+    ) -> None:
+        self.opened = time.perf_counter()
         self.__name = name
+        self.__engine = engine if engine is not None else FileEngine(name)
+        # a memory budget keeps only the key index resident, values beyond
+        # it are evicted in LRU order and read back from the engine
+        self.__lazy = lazy or max_memory is not None
+        self.__max_memory = max_memory
+        self.__cache = OrderedDict()
+        self.__resident = 0
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
         self.__items = {}
-        if os.path.exists(self.__name):
-            self.load()
-        else:
-            os.makedirs(self.__name, exist_ok=True)
+        self.__keys = SortedKeys()
+        # secondary indexes by field path, kept in memory only
+        self.__indexes: dict[str, FieldIndex] = {}
+        self.__load_ms = 0.0
+        # Reads share the lock and writes take it alone, so every write is
+        # applied, logged and versioned before anyone sees it. Lazy loading
+        # and the LRU cache change state on reads, they have their own lock.
+        self.__lock = RWLock()
+        self.__cache_lock = threading.Lock()
+        # Every write takes the next tick of a clock that follows the wall
+        # clock in microseconds. Keys loaded at boot share the boot tick.
+        # A lease on the clock is kept on disk ahead of every tick handed
+        # out, so versions keep growing across restarts even if the wall
+        # clock stepped back, and `if_version` never matches an older value.
+        self.__clock = self.__read_clock()
+        self.__lease = self.__clock
+        self.__epoch = 0
+        self.__versions: dict[str, int] = {}
+        self.__view = Items(self.__copy)
+        self.load()
 
+    # Saving takes no store lock, so writers keep going while a save waits
+    # for the disk and group commit can batch them. Engines guard their own
+    # state and only ever copy the items for snapshots, under the read lock.
     def save(self) -> None:
-        def stringify(v):
-            match v:
-                case dict():
-                    return {k: stringify(v) for k, v in v.items()}
-                case list():
-                    return [stringify(v) for v in v]
-                case bytes():
-                    return v.decode("utf-8")
-                case _:
-                    return v
+        self.__engine.save(self.__view)
 
-        for k in self.__items:
-            with open(f"{self.__name}/{stringify(k)}", "w") as f:
-                f.write(json.dumps(stringify(self.__items[k])))
+    def __copy(self) -> dict:
+        with self.__lock.read():
+            return dict(self.__items)
 
     def load(self) -> None:
-        for k in os.listdir(self.__name):
-            with open(f"{self.__name}/{k}", "r") as f:
-                self.__items[k] = json.loads(f.read())
+        with self.__lock.write():
+            self.__load()
 
-    def insert(self, k: str, v: dict) -> None | dict:
+    def __load(self) -> None:
+        start = time.perf_counter()
+        self.__cache = OrderedDict()
+        self.__resident = 0
+        if self.__lazy:
+            self.__items = dict.fromkeys(self.__engine.index(), UNLOADED)
+        else:
+            self.__items = self.__engine.load()
+        self.__keys = SortedKeys(self.__items)
+        self.__epoch = self.__tick()
+        self.__versions = {}
+        self.__load_ms = 1000 * (time.perf_counter() - start)
+        for field, index in list(self.__indexes.items()):
+            self.__create_index(field, index.kind)
 
-        result = self.__items.get(k)
-        self.__items[k] = v
+    def create_index(self, field: str, kind: str) -> None:
+        if kind not in INDEXES:
+            raise ValueError(f"Unsupported index kind: {kind}")
+        with self.__lock.write():
+            self.__create_index(field, kind)
+
+    def __create_index(self, field: str, kind: str) -> None:
+        start = time.perf_counter()
+        index = INDEXES[kind](field)
+        index.build((k, self.__value(k)) for k in self.__keys)
+        index.build_ms = 1000 * (time.perf_counter() - start)
+        self.__indexes[field] = index
+
+    def query(self, field: str, where: dict) -> list[dict]:
+        with self.__lock.read():
+            if field not in self.__indexes:
+                raise ValueError(f"No index on '{field}'")
+            return [{k: self.__value(k)} for k in self.__indexes[field].find(where)]
+
+    def __value(self, k: str) -> None | dict:
+        v = self.__items[k]
+        if v is not UNLOADED and self.__max_memory is None:
+            return v
+        with self.__cache_lock:
+            v = self.__items[k]
+            if v is UNLOADED:
+                self.__misses += 1
+                v = self.__items[k] = self.__engine.read(k)
+                self.__cache_put(k, v)
+            elif self.__max_memory is not None:
+                self.__hits += 1
+                self.__cache.move_to_end(k)
+        return v
+
+    def __cache_put(self, k: str, v: dict) -> None:
+        if self.__max_memory is None:
+            return
+
+        size = len(k) + len(encode(v))
+        self.__resident += size - self.__cache.pop(k, 0)
+        self.__cache[k] = size
+        while self.__resident > self.__max_memory and len(self.__cache) > 1:
+            evicted, size = self.__cache.popitem(last=False)
+            self.__items[evicted] = UNLOADED
+            self.__resident -= size
+            self.__evictions += 1
+
+    def __cache_drop(self, k: str) -> None:
+        if self.__max_memory is not None:
+            self.__resident -= self.__cache.pop(k, 0)
+
+    def close(self) -> None:
+        self.__engine.close()
+
+    def snapshot(self) -> None:
+        self.__engine.snapshot(self.__view)
+
+    def stats(self) -> dict:
+        with self.__lock.read():
+            return self.__stats()
+
+    def __stats(self) -> dict:
+        return {
+            "keys": len(self.__items),
+            "lazy": self.__lazy,
+            "load_ms": self.__load_ms,
+            "cache": {
+                "max_memory": self.__max_memory,
+                "resident_bytes": self.__resident,
+                "resident_keys": len(self.__cache),
+                "hits": self.__hits,
+                "misses": self.__misses,
+                "evictions": self.__evictions,
+            },
+            "indexes": {field: index.stats() for field, index in self.__indexes.items()},
+            "engine": self.__engine.stats(),
+        }
+
+    def __tick(self) -> int:
+        self.__clock = max(self.__clock + 1, time.time_ns() // 1000)
+        if self.__clock >= self.__lease:
+            self.__lease = self.__clock + CLOCK_LEASE
+            self.__write_clock(self.__lease)
+        return self.__clock
+
+    def __read_clock(self) -> int:
+        try:
+            with open(f"{self.__name}/{CLOCK}") as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            return 0
 
+    def __write_clock(self, lease: int) -> None:
+        os.makedirs(self.__name, exist_ok=True)
+        tmp = f"{self.__name}/{CLOCK}.tmp"
+        with open(tmp, "w") as f:
+            f.write(str(lease))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, f"{self.__name}/{CLOCK}")
+
+    def version(self, k: str) -> int | None:
+        with self.__lock.read():
+            return self.__version(k)
+
+    def __version(self, k: str) -> int | None:
+        return self.__versions.get(k, self.__epoch) if k in self.__items else None
+
+    def __check_version(self, k: str, if_version: int | None) -> None:
+        if if_version is not None and (self.__version(k) or 0) != if_version:
+            raise Conflict(k, self.__version(k) or 0)
+
+    def insert(self, k: str, v: dict, if_version: int | None = None) -> None | dict:
+        return self.insert_versioned(k, v, if_version)[0]
+
+    # the previous value and the version the write took, read together
+    def insert_versioned(self, k: str, v: dict, if_version: int | None = None) -> tuple[None | dict, int]:
+        with self.__lock.write():
+            self.__check_version(k, if_version)
+            self.__engine.check(k)
+            result = self.__put(k, v)
+            self.__engine.insert(k, v)
+            return result, self.__version(k)
+
+    # The batch variants hand the engine all their writes at once and
+    # answer per key, in order.
+    def insert_many(self, kvs: list[tuple[str, dict]]) -> list[None | dict]:
+        for k, _ in kvs:
+            self.__engine.check(k)
+        with self.__lock.write():
+            results = [self.__put(k, v) for k, v in kvs]
+            if kvs:
+                self.__engine.batch([["insert", k, v] for k, v in kvs])
+            return results
+
+    def __put(self, k: str, v: dict) -> None | dict:
+        result = self.__value(k) if k in self.__items else None
+        if k not in self.__items:
+            self.__keys.add(k)
+        for index in self.__indexes.values():
+            index.add(k, v)
+        self.__items[k] = v
+        self.__versions[k] = self.__tick()
+        self.__cache_put(k, v)
         return result
 
+    def __forget(self, k: str) -> None:
+        del self.__items[k]
+        self.__versions.pop(k, None)
+        self.__keys.discard(k)
+        for index in self.__indexes.values():
+            index.discard(k)
+        self.__cache_drop(k)
+
     def get(self, k: str) -> None | dict:
-        return self.__items.get(k)
-
-    def select(self, k: str) -> list[dict]:
-        k = re.compile(k)
-        result = []
-        for key in self.__items:
-            if k.match(key):
-                result.append({key: self.__items[key]})
-        return result
+        with self.__lock.read():
+            return self.__get(k)
 
-    def delete(self, k: str) -> None | dict:
-        result = self.__items.get(k)
+    def __get(self, k: str) -> None | dict:
+        return self.__value(k) if k in self.__items else None
 
-        if result is not None:
-            del self.__items[k]
+    def get_versioned(self, k: str) -> tuple[None | dict, int | None]:
+        with self.__lock.read():
+            return self.__get(k), self.__version(k)
 
-        return result
+    def get_many(self, ks: list[str]) -> list[None | dict]:
+        with self.__lock.read():
+            return [self.__get(k) for k in ks]
+
+    # Applies ["insert", k, v] and ["delete", k] ops all or nothing. Every
+    # check, {"key": k} with "value": v, "version": n or "exists": bool, has
+    # to hold first, or nothing is applied and Conflict names the first key
+    # that failed. The writes reach the engine as one batch.
+    def transact(self, ops: list[list], checks: list[dict] = ()) -> list[None | dict]:
+        for op in ops:
+            match op:
+                case ["insert", str() as k, _]:
+                    self.__engine.check(k)
+                case ["delete", str()]:
+                    pass
+                case _:
+                    raise ValueError(f"Unsupported op: {op}")
+        for check in checks:
+            if not isinstance(check, dict) or not isinstance(check.get("key"), str):
+                raise ValueError(f"Unsupported check: {check}")
+            if not set(check) - {"key"} <= {"value", "version", "exists"}:
+                raise ValueError(f"Unsupported check: {check}")
+
+        with self.__lock.write():
+            for check in checks:
+                if not self.__holds(check):
+                    raise Conflict(check["key"])
+
+            results = []
+            logged = []
+            for op in ops:
+                match op:
+                    case ["insert", k, v]:
+                        results.append(self.__put(k, v))
+                        logged.append(op)
+                    case ["delete", k]:
+                        if k in self.__items:
+                            results.append(self.__value(k))
+                            self.__forget(k)
+                            logged.append(op)
+                        else:
+                            results.append(None)
+            if logged:
+                self.__engine.batch(logged)
+            return results
+
+    def __holds(self, check: dict) -> bool:
+        k = check["key"]
+        exists = k in self.__items
+        if "exists" in check and exists != check["exists"]:
+            return False
+        if "value" in check and (not exists or self.__value(k) != check["value"]):
+            return False
+        if "version" in check and (self.__version(k) or 0) != check["version"]:
+            return False
+        return True
+
+    def select(self, k: str, glob: bool = False, budget: int | None = None) -> list[dict]:
+        return [{key: v} for key, v in self.scan(k, glob, budget)]
+
+    # Yields matching (key, value) pairs in key order, starting after `after`.
+    # Without `values` only the keys are looked at and the values are None.
+    # The read lock is held for one chunk of keys at a time, so a slow
+    # consumer does not hold writers off. Each key is seen at most once, but
+    # writes between chunks may show up in later ones.
+    def scan(
+        self,
+        k: str,
+        glob: bool = False,
+        budget: int | None = None,
+        after: str | None = None,
+        values: bool = True,
+    ):
+        match = compile_pattern(k, glob)
+        tested = 0
+        while True:
+            chunk = SCAN_CHUNK if budget is None else min(SCAN_CHUNK, budget - tested)
+            rows = []
+            with self.__lock.read():
+                try:
+                    for row in self.__scan(match, chunk, after, values):
+                        rows.append(row)
+                    done = True
+                except BudgetExceeded as e:
+                    done, after = False, e.key
+            yield from rows
+            if done:
+                return
+            tested += chunk
+            if budget is not None and tested >= budget:
+                raise BudgetExceeded(after)
+
+    # Raises BudgetExceeded once `budget` keys have been tested and more are
+    # left, carrying the last key tested.
+    def __scan(self, match: tuple, budget: int | None, after: str | None, values: bool):
+        # every match starts with the pattern's literal prefix, so only
+        # that range of the sorted index needs to be tested
+        prefix, matches = match
+        last = after
+        for tested, key in enumerate(self.__keys.prefix(prefix, after)):
+            if budget is not None and tested >= budget:
+                raise BudgetExceeded(last)
+            last = key
+            if matches(key):
+                yield key, self.__value(key) if values else None
+
+    def count(self, k: str, glob: bool = False, budget: int | None = None) -> int:
+        match = compile_pattern(k, glob)
+        with self.__lock.read():
+            return sum(1 for _ in self.__scan(match, budget, None, False))
+
+    # Deletes every key matching `k` and hands the engine a single batch, so
+    # an engine that logs batches as one record applies all of it or none.
+    # The keys are collected first, so running out of budget deletes nothing.
+    def delete_range(self, k: str, glob: bool = False, budget: int | None = None) -> int:
+        match = compile_pattern(k, glob)
+        with self.__lock.write():
+            keys = [key for key, _ in self.__scan(match, budget, None, False)]
+            for key in keys:
+                self.__forget(key)
+            if keys:
+                self.__engine.batch([["delete", key] for key in keys])
+            return len(keys)
+
+    # Counts the records whose key matches `k` and sums, and takes the min
+    # and max of, the numbers at `field`, per value at `by` if given. When
+    # every field involved is indexed the values are read from the indexes
+    # and only the keys are scanned.
+    def aggregate(
+        self,
+        k: str,
+        field: str | None = None,
+        by: str | None = None,
+        glob: bool = False,
+        budget: int | None = None,
+    ) -> dict:
+        match = compile_pattern(k, glob)
+        with self.__lock.read():
+            return self.__aggregate(match, field, by, budget)
+
+    def __aggregate(self, match: tuple, field: str | None, by: str | None, budget: int | None) -> dict:
+        paths = [path for path in (field, by) if path is not None]
+        indexed = all(path in self.__indexes for path in paths)
+
+        groups = {}
+        for key, v in self.__scan(match, budget, None, not indexed):
+            group = self.__field(by, key, v) if by is not None else None
+            acc = groups.get(group)
+            if acc is None:
+                acc = groups[group] = {"count": 0}
+            acc["count"] += 1
+            if field is None:
+                continue
+            x = self.__field(field, key, v)
+            if x is None or x[0] != 2:
+                continue
+            x = x[1]
+            if "sum" not in acc:
+                acc.update(values=1, sum=x, min=x, max=x)
+            else:
+                acc["values"] += 1
+                acc["sum"] += x
+                acc["min"] = min(acc["min"], x)
+                acc["max"] = max(acc["max"], x)
+
+        for acc in groups.values():
+            if "sum" in acc:
+                acc["avg"] = acc["sum"] / acc["values"]
+        if by is None:
+            return groups.get(None, {"count": 0})
+        return {
+            "groups": [
+                {"group": None if group is None else group[1]} | acc
+                for group, acc in sorted(groups.items(), key=lambda g: g[0] or (-1,))
+            ]
+        }
+
+    # the sort key of the value at `path`, from its index when there is one
+    def __field(self, path: str, key: str, v: object) -> tuple | None:
+        index = self.__indexes.get(path)
+        if index is not None:
+            return index.values.get(key)
+        sk = sort_key(resolve(v, path.split(".")))
+        return sk if sk is not None and sk[0] != 0 else None
+
+    def delete(self, k: str, if_version: int | None = None) -> None | dict:
+        with self.__lock.write():
+            self.__check_version(k, if_version)
+            result = self.__value(k) if k in self.__items else None
+
+            if result is not None:
+                self.__forget(k)
+                self.__engine.delete(k)
+
+            return result
+
+    def delete_many(self, ks: list[str]) -> list[None | dict]:
+        with self.__lock.write():
+            results = []
+            deleted = []
+            for k in ks:
+                result = self.__value(k) if k in self.__items else None
+                if result is not None:
+                    self.__forget(k)
+                    deleted.append(["delete", k])
+                results.append(result)
+            if deleted:
+                self.__engine.batch(deleted)
+            return results
@@ -0,0 +1,125 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from message import Message, Shutdown, frame_response
+from store import Store, respond, respond_bytes
+
+# Requests on the raw TCP front end are framed like a pipelined POST body
+# (see message.frame), and so are the answers. A connection may send any
+# number of requests without waiting, they are answered in order.
+
+
+# The raw bytes of one encoded value, however deeply nested.
+async def read_value(reader: asyncio.StreamReader) -> bytes:
+    line = await reader.readuntil(b"\r\n")
+    match line[:1]:
+        case b"$" | b"!":
+            length = int(line[1:-2])
+            if length < 0:
+                return line
+            return line + await reader.readexactly(length + 2)
+        case b"^" | b"*":
+            # objects hold a key and a value per entry
+            n = int(line[1:-2]) * (2 if line[:1] == b"*" else 1)
+            return line + b"".join([await read_value(reader) for _ in range(n)])
+        case b":" | b"|" | b",":
+            return line
+        case _:
+            raise ValueError(f"Unsupported type: {line[:1]!r}")
+
+
+class TCPStoreServer:
+    def __init__(
+        self,
+        server_address,
+        store: Store | None = None,
+        match_budget: int | None = None,
+        workers: int = 8,
+    ):
+        self.server_address = server_address
+        self.store = store if store is not None else Store(".store")
+        self.match_budget = match_budget
+        self.running = True
+        self.first_request_ms = None
+        # store calls wait on locks and the disk, so they run on a pool and
+        # the event loop only moves bytes
+        self.executor = ThreadPoolExecutor(workers)
+        # the writer of every open connection, by its task
+        self.connections = {}
+        self.loop = None
+        self.stopped = None
+        # set once listening, `server_address` then holds the bound port
+        self.ready = threading.Event()
+        self.close_store = False
+
+    # answers one message, see store.respond
+    def respond(self, msg: Message, save: bool = True) -> tuple:
+        return respond(self, msg, save)
+
+    def serve_forever(self) -> None:
+        asyncio.run(self.serve())
+
+    # Safe to call from any thread, like HTTPServer.shutdown.
+    def shutdown(self) -> None:
+        self.ready.wait()
+        self.loop.call_soon_threadsafe(self.stopped.set)
+
+    async def serve(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        host, port = self.server_address
+        server = await asyncio.start_server(self.connection, host, port)
+        self.server_address = server.sockets[0].getsockname()[:2]
+        self.ready.set()
+        await self.stopped.wait()
+
+        # closing a connection ends its next read, so a request in flight
+        # is still answered (into a closed socket) before its task is done
+        server.close()
+        for writer in self.connections.values():
+            writer.close()
+        await asyncio.gather(*self.connections, return_exceptions=True)
+        await server.wait_closed()
+        # requests already handed to the pool still finish
+        self.executor.shutdown()
+        if self.close_store:
+            self.store.close()
+
+    async def connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        self.connections[task] = writer
+        try:
+            while True:
+                try:
+                    header = await reader.readuntil(b"\r\n")
+                    if not header.startswith(b"^"):
+                        raise ValueError(f"Expected a list, got {header[:1]!r}")
+                    parts = [await read_value(reader) for _ in range(int(header[1:-2]))]
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    return
+                except (ValueError, asyncio.LimitOverrunError):
+                    # the stream can not be framed any more
+                    writer.write(frame_response(400, b"BAD FRAME", None))
+                    await writer.drain()
+                    return
+
+                try:
+                    msg = Message.deserialize(b"".join(parts))
+                except (KeyError, ValueError, IndexError, TypeError):
+                    writer.write(frame_response(400, b"BAD REQUEST", None))
+                    await writer.drain()
+                    continue
+
+                status, body, version = await self.loop.run_in_executor(self.executor, respond_bytes, self, msg)
+                writer.write(frame_response(status, body, version))
+                await writer.drain()
+                # a stopped server answers Shutdown with a 503 and keeps going
+                if status == 200 and isinstance(msg, Shutdown):
+                    self.close_store = True
+                    self.stopped.set()
+                    return
+        except ConnectionError:
+            return
+        finally:
+            del self.connections[task]
+            writer.close()
@@ -0,0 +1,42 @@
+from hypothesis import given, settings
+from hypothesis.strategies import lists, booleans
+
+from kvstore.store import Store
+from kvstore.bitcask import BitcaskEngine
+from kvstore.codec import Codec
+from kvstore.message import Insert, Delete
+from kvstore.test_wal import mutations, contents, apply
+
+import tempfile
+import datetime
+
+
+@given(mutations(), lists(booleans()))
+@settings(deadline=datetime.timedelta(milliseconds=5000))
+def test_compaction(ms: list[Insert | Delete], compactions: list[bool]) -> None:
+    with tempfile.TemporaryDirectory() as d:
+        engine = BitcaskEngine(d, fsync=False, max_segment=256, codec=Codec(16))
+        store = Store(d, engine)
+
+        def compact(i: int, st: dict) -> None:
+            if i < len(compactions) and compactions[i]:
+                engine.compact()
+                reopened = Store(d, BitcaskEngine(d))
+                assert contents(reopened) == st
+                reopened.close()
+
+        st = apply(store, ms, step=compact)
+        store.close()
+
+        store = Store(d, BitcaskEngine(d))
+        assert contents(store) == st
+        store.close()
+
+        store = Store(d, BitcaskEngine(d, codec=Codec(16)), lazy=True)
+        assert contents(store) == st
+        store.close()
+
+
+if __name__ == "__main__":
+    test_compaction()
+    print("Done")
@@ -0,0 +1,82 @@
+from hypothesis import given, settings
+from hypothesis.strategies import (
+    composite,
+    DrawFn,
+    text,
+    integers,
+    floats,
+    none,
+    booleans,
+    binary,
+    lists,
+    dictionaries,
+)
+
+from kvstore.codec import encode, decode, Codec, train
+from kvstore.test_message import weighted_choice
+
+import json
+
+
+@composite
+def values(draw: DrawFn, depth: int = 3) -> object:
+    return draw(weighted_choice(
+        [
+            (1, none()),
+            (1, booleans()),
+            (1, integers()),
+            (1, floats(allow_nan=False)),
+            (1, text()),
+            (1, binary()),
+            (depth, lists(values(depth=depth - 1), max_size=10)),
+            (depth, dictionaries(
+                keys=text(),
+                values=values(depth=depth - 1),
+                max_size=10,
+            )),
+        ],
+    ))
+
+
+@given(values(), booleans())
+@settings(max_examples=1000)
+def test_roundtrip(v: object, typed: bool) -> None:
+    decoded = decode(encode(v, typed))
+    assert decoded == v and type(decoded) is type(v), f"{v} != {decoded}"
+
+
+# JSON is the fast path, the typed encoding only takes what it can not hold
+@given(values())
+def test_json_first(v: object) -> None:
+    try:
+        json.dumps(v)
+    except TypeError:
+        assert encode(v)[:1] not in b'{["-0123456789tfnIN'
+        return
+    assert json.loads(encode(v)) == v
+
+
+@given(values(), lists(values(), max_size=5), integers(min_value=0, max_value=64), booleans())
+def test_compression(v: object, samples: list[object], threshold: int, typed: bool) -> None:
+    zdict = train(samples, typed=typed) or None
+    for codec in (Codec(threshold, typed=typed), Codec(threshold, zdict=zdict, typed=typed)):
+        data = codec.encode(v)
+        assert len(data) <= len(encode(v, typed))
+        assert codec.decode(data) == v
+
+
+@given(values())
+def test_reads_json(v: object) -> None:
+    try:
+        data = json.dumps(v).encode()
+    except TypeError:
+        return
+    assert decode(data) == json.loads(data)
+
+
+if __name__ == "__main__":
+    test_roundtrip()
+    test_json_first()
+    test_compression()
+    test_reads_json()
+    print("Done")
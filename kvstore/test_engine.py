@@ -0,0 +1,181 @@
+from hypothesis import given, settings
+from hypothesis.strategies import (
+    composite,
+    DrawFn,
+    one_of,
+    lists,
+    text,
+    dictionaries,
+    integers,
+    sampled_from,
+)
+
+from kvstore.store import Store
+from kvstore.engine import FileEngine, CLOCK
+from kvstore.bitcask import BitcaskEngine
+from kvstore.wal import WALEngine
+from kvstore.flusher import GroupCommit
+from kvstore.convert import convert
+from kvstore.message import Insert, Delete
+from kvstore.test_message import json
+from kvstore.test_wal import apply
+
+import os
+import string
+import tempfile
+import datetime
+
+
+@composite
+def keys(draw: DrawFn) -> str:
+    # one file per key, so keys have to be valid file names
+    return draw(text(alphabet=string.ascii_letters + string.digits, min_size=1))
+
+
+@composite
+def mutations(draw: DrawFn) -> list[Insert | Delete]:
+    return draw(
+        lists(
+            one_of(
+                keys().map(lambda k: Delete(k=k)),
+                keys().flatmap(lambda k: json().map(lambda v: Insert(k=k, v=v))),
+            ),
+            max_size=50,
+        )
+    )
+
+
+@given(mutations())
+@settings(deadline=datetime.timedelta(milliseconds=5000))
+def test_incremental_save(ms: list[Insert | Delete]) -> None:
+    with tempfile.TemporaryDirectory() as d:
+        store = Store(d, FileEngine(d, fsync=False))
+        st = apply(store, ms)
+
+        # deleted keys must be gone from disk, not just from memory
+        assert {e.name for e in os.scandir(d) if e.is_file()} - {CLOCK} == set(st)
+
+        store = Store(d, FileEngine(d))
+        assert {k: v for obj in store.select(".*") for k, v in obj.items()} == st
+
+        store = Store(d, FileEngine(d), lazy=True)
+        assert {k: store.get(k) for k in st} == st
+
+        store = Store(d, FileEngine(d, workers=4, batch=3))
+        assert {k: v for obj in store.select(".*") for k, v in obj.items()} == st
+
+
+@given(mutations(), integers(min_value=0, max_value=200))
+@settings(deadline=datetime.timedelta(milliseconds=5000))
+def test_bounded_cache(ms: list[Insert | Delete], max_memory: int) -> None:
+    with tempfile.TemporaryDirectory() as d:
+        store = Store(d, FileEngine(d, fsync=False), max_memory=max_memory)
+        # evicted values must come back even before they are saved
+        st = apply(store, ms, save=False, step=lambda i, st: i % 2 and store.save())
+
+        assert {k: store.get(k) for k in st} == st
+        cache = store.stats()["cache"]
+        assert cache["resident_keys"] <= 1 or cache["resident_bytes"] <= max_memory
+
+
+# A key that can not be written stays dirty, and does not cost the others
+# their write.
+@given(dictionaries(keys(), json(), max_size=20))
+@settings(deadline=datetime.timedelta(milliseconds=5000))
+def test_failed_save(st: dict) -> None:
+    with tempfile.TemporaryDirectory() as d:
+        store = Store(d, FileEngine(d, fsync=False))
+        try:
+            store.insert(".tmp", 1)
+            assert False, "the temp directory's name was accepted as a key"
+        except ValueError:
+            pass
+
+        store.insert("a/b", 1)
+        for k, v in st.items():
+            store.insert(k, v)
+        for _ in range(2):
+            try:
+                store.save()
+                assert False, "saving a key with a slash succeeded"
+            except OSError:
+                pass
+            assert {e.name for e in os.scandir(d) if e.is_file()} - {CLOCK} == set(st)
+
+        store.delete("a/b")
+        store.save()
+        assert {k: v for obj in Store(d, FileEngine(d)).select(".*") for k, v in obj.items()} == st
+
+
+@given(dictionaries(keys(), json(), max_size=50))
+@settings(deadline=datetime.timedelta(milliseconds=5000))
+def test_convert(st: dict) -> None:
+    with tempfile.TemporaryDirectory() as src, tempfile.TemporaryDirectory() as dst:
+        store = Store(src, FileEngine(src, fsync=False))
+        for k, v in st.items():
+            store.insert(k, v)
+        store.save()
+
+        # converting leaves the source as it was, leftover temp files too
+        with open(f"{src}/.tmp/leftover", "wb") as f:
+            f.write(b"partial")
+        before = sorted(os.walk(src))
+        assert convert(src, dst) == len(st)
+        assert sorted(os.walk(src)) == before
+        assert os.path.exists(f"{src}/.tmp/leftover")
+        store = Store(dst, BitcaskEngine(dst), lazy=True)
+        assert {k: store.get(k) for k in st} == st
+        assert len(store.select(".*")) == len(st)
+        store.close()
+
+
+engines = {
+    "files": lambda d: FileEngine(d, fsync=False),
+    "wal": lambda d: WALEngine(d, fsync="never"),
+    "bitcask": lambda d: BitcaskEngine(d, fsync=False),
+    "group": lambda d: GroupCommit(WALEngine(d, fsync="never"), "sync"),
+}
+
+
+@given(lists(mutations(), max_size=5), sampled_from(sorted(engines)))
+@settings(deadline=datetime.timedelta(milliseconds=5000))
+def test_batches(batches: list[list[Insert | Delete]], engine: str) -> None:
+    with tempfile.TemporaryDirectory() as d, tempfile.TemporaryDirectory() as single:
+        store = Store(d, engines[engine](d))
+        model = Store(single, engines[engine](single))
+        for ms in batches:
+            # runs of inserts and deletes go out as one batch each, and have
+            # to answer exactly like the same writes sent one at a time
+            runs = []
+            for m in ms:
+                if runs and type(runs[-1][0]) is type(m):
+                    runs[-1].append(m)
+                else:
+                    runs.append([m])
+            for run in runs:
+                if isinstance(run[0], Insert):
+                    results = store.insert_many([(m.k, m.v) for m in run])
+                    assert results == [model.insert(m.k, m.v) for m in run]
+                else:
+                    results = store.delete_many([m.k for m in run])
+                    assert results == [model.delete(m.k) for m in run]
+            keys = [m.k for m in ms]
+            assert store.get_many(keys) == [model.get(k) for k in keys]
+            store.save()
+            model.save()
+        st = {k: v for obj in model.select(".*") for k, v in obj.items()}
+        store.close()
+        model.close()
+
+        store = Store(d, engines[engine](d))
+        assert {k: v for obj in store.select(".*") for k, v in obj.items()} == st
+        store.close()
+
+
+if __name__ == "__main__":
+    test_incremental_save()
+    test_bounded_cache()
+    test_failed_save()
+    test_convert()
+    test_batches()
+    print("Done")
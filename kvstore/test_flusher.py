@@ -0,0 +1,82 @@
+from hypothesis import given, settings
+from hypothesis.strategies import sampled_from
+
+from kvstore.store import Store
+from kvstore.wal import WALEngine
+from kvstore.engine import FileEngine
+from kvstore.flusher import GroupCommit
+from kvstore.message import Insert, Delete
+from kvstore.test_wal import mutations, contents, apply
+
+from threading import Thread
+import tempfile
+import datetime
+
+
+@given(mutations(), sampled_from(["sync", "group", "async"]))
+@settings(deadline=datetime.timedelta(milliseconds=5000))
+def test_durability_modes(ms: list[Insert | Delete], mode: str) -> None:
+    with tempfile.TemporaryDirectory() as d:
+        store = Store(d, GroupCommit(WALEngine(d, fsync="never"), mode, interval=0.001))
+        st = apply(store, ms)
+        store.close()
+
+        store = Store(d, WALEngine(d))
+        assert contents(store) == st
+        store.close()
+
+
+def test_coalescing() -> None:
+    with tempfile.TemporaryDirectory() as d:
+        engine = GroupCommit(WALEngine(d, fsync="never"), "sync")
+        store = Store(d, engine)
+        for i in range(100):
+            store.insert("k", i)
+        store.save()
+
+        stats = engine.stats()
+        assert stats["flushes"] == 1
+        assert stats["mutations"] == 100
+        assert stats["engine"]["records"] == 1
+        store.close()
+
+
+# A batch the engine refuses is kept and tried again, and the writers
+# waiting for it get the error instead of waiting forever.
+@given(sampled_from(["sync", "group"]))
+@settings(deadline=datetime.timedelta(milliseconds=5000), max_examples=4)
+def test_failed_flush(mode: str) -> None:
+    with tempfile.TemporaryDirectory() as d:
+        engine = GroupCommit(FileEngine(d, fsync=False), mode, interval=0.01)
+        store = Store(d, engine)
+        errors = []
+
+        def save() -> None:
+            try:
+                store.save()
+            except OSError as e:
+                errors.append(e)
+
+        # a key with a slash can not be written as a file
+        store.insert("a/b", 1)
+        store.insert("c", 2)
+        saving = Thread(target=save, daemon=True)
+        saving.start()
+        saving.join(timeout=2.0)
+        assert not saving.is_alive() and len(errors) == 1
+        assert engine.stats()["error"] is not None
+
+        store.delete("a/b")
+        store.save()
+        assert engine.thread is None or engine.thread.is_alive()
+        store.close()
+
+        store = Store(d, FileEngine(d))
+        assert contents(store) == {"c": 2}
+
+
+if __name__ == "__main__":
+    test_durability_modes()
+    test_coalescing()
+    test_failed_flush()
+    print("Done")
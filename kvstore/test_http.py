@@ -0,0 +1,208 @@
+from hypothesis import given, settings
+from hypothesis.strategies import composite, integers, lists, sampled_from, binary
+
+from kvstore.store import Store, StoreServer, StoreHandler
+from kvstore.client import Client
+from kvstore.wal import WALEngine
+from kvstore.message import Insert, Get, Delete, MultiGet, Select, Count, DeleteRange, Stop, Startup, Message, serialize
+
+from threading import Thread
+import tempfile
+import datetime
+import http.client
+import socket
+import base64
+import json
+import time
+
+
+def serve(d: str, **kwargs) -> StoreServer:
+    server = StoreServer(("localhost", 0), StoreHandler, Store(d, WALEngine(d, fsync="never")), **kwargs)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# One connection carries requests until the per-connection limit.
+@given(integers(min_value=1, max_value=40), integers(min_value=1, max_value=10))
+@settings(deadline=datetime.timedelta(milliseconds=5000), max_examples=20)
+def test_keep_alive(n: int, max_requests: int) -> None:
+    with tempfile.TemporaryDirectory() as d:
+        server = serve(d, max_requests=max_requests)
+        conn = http.client.HTTPConnection(*server.server_address)
+        closes = 0
+        for i in range(n):
+            conn.request("POST", "/", Insert(k=str(i), v=i).serialize())
+            resp = conn.getresponse()
+            assert resp.read() == b"OK"
+            assert int(resp.getheader("Content-Length")) == 2
+            if resp.will_close:
+                closes += 1
+                assert (i + 1) % max_requests == 0
+        assert closes == n // max_requests
+        conn.close()
+        server.shutdown()
+        server.server_close()
+        server.store.close()
+
+
+# An idle connection is dropped, and a client waiting on a single-threaded
+# server is let in after the current request, or at once if the server is
+# only waiting for the next one.
+def test_idle_and_waiting() -> None:
+    with tempfile.TemporaryDirectory() as d:
+        server = serve(d, idle_timeout=0.2)
+        first = Client(*server.server_address, prefix="a")
+        first.request(Insert(k="x", v=1))
+        time.sleep(0.5)
+        # the client sends its request again on a fresh connection
+        assert first.request(Get(k="x")) == "1"
+        first.close()
+        server.shutdown()
+        server.server_close()
+        server.store.close()
+
+        server = serve(d, idle_timeout=5.0)
+        first = Client(*server.server_address, prefix="a")
+        first.request(Get(k="x"))
+        second = Client(*server.server_address, prefix="b")
+        thread = Thread(target=second.request, args=(Insert(k="y", v=2),))
+        thread.start()
+        time.sleep(0.1)
+        first.request(Get(k="x"))
+        thread.join(timeout=2.0)
+        assert not thread.is_alive()
+
+        first.close()
+        second.close()
+
+        # an idle kept-alive client gives way as soon as another connects
+        first = Client(*server.server_address, prefix="a")
+        first.request(Get(k="x"))
+        second = Client(*server.server_address, prefix="b")
+        start = time.perf_counter()
+        assert second.request(Get(k="y")) == "2"
+        assert time.perf_counter() - start < 1.0
+        assert first.request(Get(k="x")) == "1"
+
+        first.close()
+        second.close()
+        server.shutdown()
+        server.server_close()
+        server.store.close()
+
+
+# JSON answers carry bytes values as {"$bytes": base64}.
+@given(binary(max_size=64))
+@settings(deadline=datetime.timedelta(milliseconds=5000), max_examples=20)
+def test_bytes_values(v: bytes) -> None:
+    with tempfile.TemporaryDirectory() as d:
+        server = serve(d)
+        c = Client(*server.server_address, prefix="b")
+        c.request(Insert(k="x", v=v))
+        encoded = {"$bytes": base64.b64encode(v).decode()}
+        assert json.loads(c.request(Select(k="x"))) == [{"b_x": encoded}]
+        assert json.loads(c.request(MultiGet(ks=["x", "y"]))) == [encoded, None]
+        c.close()
+        server.shutdown()
+        server.server_close()
+        server.store.close()
+
+
+# Options of the wrong type are a bad request, not a dropped connection.
+@given(sampled_from([{"limit": "x"}, {"limit": True}, {"cursor": 1}, {"fields": "a"}, {"fields": [1]}, "x", ["limit"]]))
+@settings(deadline=datetime.timedelta(milliseconds=5000), max_examples=20)
+def test_bad_options(opts: object) -> None:
+    with tempfile.TemporaryDirectory() as d:
+        server = serve(d)
+        conn = http.client.HTTPConnection(*server.server_address)
+        if isinstance(opts, dict):
+            bodies = [cls(k="a", opts=opts).serialize() for cls in (Select, Count, DeleteRange)]
+        else:
+            typ = "list" if isinstance(opts, list) else "string"
+            bodies = [serialize("string", name) + serialize("string", "a") + serialize(typ, opts) for name in ("select", "count", "delete_range")]
+        for body in bodies:
+            conn.request("POST", "/", body)
+            resp = conn.getresponse()
+            resp.read()
+            assert resp.status == 400
+        conn.close()
+        server.shutdown()
+        server.server_close()
+        server.store.close()
+
+
+# Chunked bodies are HTTP/1.1 only, an HTTP/1.0 client gets a select whole.
+def test_http10_select() -> None:
+    with tempfile.TemporaryDirectory() as d:
+        server = serve(d)
+        server.store.insert("a", 1)
+        body = Select(k=".*").serialize()
+        with socket.create_connection(server.server_address) as sock:
+            sock.sendall(f"POST / HTTP/1.0\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+            data = b""
+            while chunk := sock.recv(4096):
+                data += chunk
+        head, _, answer = data.partition(b"\r\n\r\n")
+        assert b"chunked" not in head.lower()
+        assert f"Content-Length: {len(answer)}".encode() in head
+        assert json.loads(answer) == [{"a": 1}]
+        server.shutdown()
+        server.server_close()
+        server.store.close()
+
+
+@composite
+def messages(draw):
+    k = draw(sampled_from("abc"))
+    match draw(sampled_from(["insert", "get", "delete", "getmany", "select", "stop", "startup"])):
+        case "insert":
+            return Insert(k=k, v=draw(integers(0, 9)))
+        case "get":
+            return Get(k=k)
+        case "delete":
+            return Delete(k=k)
+        case "getmany":
+            return MultiGet(ks=["a", k])
+        case "select":
+            return Select(k=".*")
+        case "stop":
+            return Stop()
+        case "startup":
+            return Startup()
+
+
+# A pipelined body is answered the same as its messages sent one by one.
+@given(lists(messages(), max_size=20))
+@settings(deadline=datetime.timedelta(milliseconds=5000), max_examples=50)
+def test_pipeline(msgs: list) -> None:
+    answers = []
+    for pipelined in (False, True):
+        with tempfile.TemporaryDirectory() as d:
+            server = serve(d)
+            c = Client(*server.server_address, prefix="p")
+            # the client prefixes keys in place, so each run gets fresh copies
+            copies = [Message.deserialize(msg.serialize()) for msg in msgs]
+            if pipelined:
+                answers.append(c.pipeline(copies))
+            else:
+                answers.append([c.request(msg) for msg in copies])
+            c.request(Startup())
+            answers.append(c.request(Select(k=".*")))
+            c.close()
+            server.shutdown()
+            server.server_close()
+            server.store.close()
+
+    one_by_one, stored, pipelined, pipelined_stored = answers
+    assert pipelined == one_by_one
+    assert pipelined_stored == stored
+
+
+if __name__ == "__main__":
+    test_keep_alive()
+    test_idle_and_waiting()
+    test_bytes_values()
+    test_bad_options()
+    test_http10_select()
+    test_pipeline()
+    print("Done")
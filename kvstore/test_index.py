@@ -0,0 +1,137 @@
+from hypothesis import given
+from hypothesis.strategies import (
+    composite,
+    integers,
+    DrawFn,
+    text,
+    lists,
+    booleans,
+    tuples,
+    sampled_from,
+    one_of,
+    none,
+    dictionaries,
+    fixed_dictionaries,
+)
+
+from kvstore.index import SortedKeys, literal_prefix, sort_key
+from kvstore.store import Store, BudgetExceeded
+from kvstore.wal import WALEngine
+
+import re
+import tempfile
+
+
+@given(lists(tuples(booleans(), text(alphabet="abc", max_size=4))), text(alphabet="abc", max_size=3))
+def test_sorted_keys(ops: list[tuple[bool, str]], lo: str) -> None:
+    keys = SortedKeys(load=2)
+    model = set()
+    for add, k in ops:
+        if add:
+            keys.add(k)
+            model.add(k)
+        else:
+            keys.discard(k)
+            model.discard(k)
+
+    assert list(keys) == sorted(model)
+    assert len(keys) == len(model)
+    assert list(keys.irange(lo)) == sorted(k for k in model if k >= lo)
+    assert list(keys.prefix(lo)) == sorted(k for k in model if k.startswith(lo))
+
+
+@composite
+def patterns(draw: DrawFn) -> str:
+    parts = draw(lists(sampled_from(["a", "b", "\\.", ".", "a*", "b+", "c?", "[ab]", "(a|b)", "a{2}", "^"]), max_size=5))
+    return "".join(parts)
+
+
+@given(patterns(), lists(text(alphabet="ab.c", max_size=6)))
+def test_literal_prefix(pattern: str, keys: list[str]) -> None:
+    try:
+        regex = re.compile(pattern)
+    except re.error:
+        return
+    prefix = literal_prefix(pattern)
+    for k in keys:
+        if regex.match(k):
+            assert k.startswith(prefix), f"{k!r} matches {pattern!r} but not prefix {prefix!r}"
+
+
+@given(patterns(), lists(text(alphabet="ab.c", max_size=6), unique=True), integers(1, 5))
+def test_resumed_scan(pattern: str, keys: list[str], budget: int) -> None:
+    try:
+        re.compile(pattern)
+    except re.error:
+        return
+    with tempfile.TemporaryDirectory() as d:
+        store = Store(d, WALEngine(d, fsync="never"))
+        for k in keys:
+            store.insert(k, {"k": k})
+
+        # resuming after the last tested key every time the budget runs out
+        # must add up to one unbounded scan
+        rows, after = [], None
+        while True:
+            try:
+                for row in store.scan(pattern, budget=budget, after=after):
+                    rows.append(row)
+                break
+            except BudgetExceeded as e:
+                after = e.key
+        assert rows == list(store.scan(pattern))
+        assert rows == sorted((k, {"k": k}) for k in keys if re.match(pattern, k))
+        store.close()
+
+
+# a handful of keys and values so updates, collisions and mixed types show up
+fields = one_of(none(), booleans(), integers(-3, 3), sampled_from(["a", "b", "c"]))
+records = one_of(fixed_dictionaries({"f": fields}), dictionaries(sampled_from(["g"]), fields))
+
+
+@given(
+    sampled_from(["hash", "ordered"]),
+    lists(tuples(sampled_from("abcdef"), one_of(none(), records)), max_size=30),
+    fields,
+    fields,
+)
+def test_field_index(kind: str, ops: list[tuple[str, dict | None]], lo: object, hi: object) -> None:
+    with tempfile.TemporaryDirectory() as d:
+        store = Store(d, WALEngine(d, fsync="never"))
+        # half of the writes land before the index is built
+        for k, v in ops[: len(ops) // 2]:
+            if v is not None:
+                store.insert(k, v)
+            else:
+                store.delete(k)
+        store.create_index("f", kind)
+        st = {k: v for obj in store.select(".*") for k, v in obj.items()}
+        for k, v in ops[len(ops) // 2 :]:
+            if v is not None:
+                store.insert(k, v)
+                st[k] = v
+            else:
+                store.delete(k)
+                st.pop(k, None)
+
+        def field(k: str) -> tuple | None:
+            return sort_key(st[k].get("f")) if isinstance(st[k], dict) else None
+
+        if lo is None:
+            return
+        found = store.query("f", {"eq": lo})
+        assert sorted(next(iter(obj)) for obj in found) == sorted(k for k in st if field(k) == sort_key(lo))
+
+        if kind == "ordered" and hi is not None and sort_key(lo)[0] == sort_key(hi)[0]:
+            found = store.query("f", {"gte": lo, "lt": hi})
+            expected = [k for k in st if field(k) is not None and sort_key(lo) <= field(k) < sort_key(hi)]
+            assert [next(iter(obj)) for obj in found] == sorted(expected, key=lambda k: (field(k), k))
+        store.close()
+
+
+if __name__ == "__main__":
+    test_sorted_keys()
+    test_literal_prefix()
+    test_resumed_scan()
+    test_field_index()
+    print("Done")
@@ -0,0 +1,94 @@
+from hypothesis import given, settings
+from hypothesis.strategies import integers, sampled_from
+
+from kvstore.store import Store, Conflict
+from kvstore.wal import WALEngine
+from kvstore.flusher import GroupCommit
+
+from threading import Thread
+import sys
+import tempfile
+import datetime
+
+
+@given(integers(min_value=1, max_value=8), integers(min_value=1, max_value=30), sampled_from(["wal", "group"]))
+@settings(deadline=datetime.timedelta(milliseconds=10000), max_examples=20)
+def test_concurrent_increments(threads: int, n: int, engine: str) -> None:
+    with tempfile.TemporaryDirectory() as d:
+        wal = WALEngine(d, fsync="never")
+        store = Store(d, wal if engine == "wal" else GroupCommit(wal, "group", interval=0.001))
+        store.insert("counter", 0)
+        errors = []
+
+        # compare-and-set loops only work if every write is linearizable
+        def increment() -> None:
+            for _ in range(n):
+                while True:
+                    v, version = store.get_versioned("counter")
+                    try:
+                        store.insert("counter", v + 1, if_version=version)
+                        store.save()
+                        break
+                    except Conflict:
+                        continue
+
+        def read() -> None:
+            for _ in range(n):
+                (row,) = store.select("counter")
+                if not isinstance(row["counter"], int):
+                    errors.append(row)
+
+        workers = [Thread(target=increment) for _ in range(threads)]
+        workers += [Thread(target=read) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        assert not errors
+        assert store.get("counter") == threads * n
+        store.close()
+
+        store = Store(d, WALEngine(d))
+        assert store.get("counter") == threads * n
+        store.close()
+
+
+@given(integers(min_value=1, max_value=4), integers(min_value=2, max_value=500))
+@settings(deadline=datetime.timedelta(milliseconds=10000), max_examples=20)
+def test_snapshot_isolation(threads: int, width: int) -> None:
+    with tempfile.TemporaryDirectory() as d:
+        wal = WALEngine(d, fsync="never")
+        store = Store(d, wal)
+        keys = [f"k{i}" for i in range(width)]
+        done = []
+
+        # every batch sets all keys to the same value, so a snapshot taken
+        # in the middle of one would show two different values
+        def write() -> None:
+            for n in range(200):
+                store.insert_many([(k, n) for k in keys])
+            done.append(True)
+
+        # switching threads often makes a torn copy likely if it can happen
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            workers = [Thread(target=write) for _ in range(threads)]
+            for worker in workers:
+                worker.start()
+            while len(done) < threads:
+                store.snapshot()
+                snapshot = wal.read_snapshot(wal.files("snap")[-1])
+                assert len(set(snapshot.values())) <= 1
+            for worker in workers:
+                worker.join()
+        finally:
+            sys.setswitchinterval(interval)
+        store.close()
+
+
+if __name__ == "__main__":
+    test_concurrent_increments()
+    test_snapshot_isolation()
+    print("Done")
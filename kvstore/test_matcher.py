@@ -0,0 +1,56 @@
+from hypothesis import given
+from hypothesis.strategies import (
+    composite,
+    DrawFn,
+    text,
+    lists,
+    sampled_from,
+)
+
+from kvstore.matcher import Glob
+from kvstore.store import Store, BudgetExceeded
+from kvstore.wal import WALEngine
+
+import fnmatch
+import tempfile
+
+
+@composite
+def patterns(draw: DrawFn) -> str:
+    parts = draw(lists(sampled_from(["a", "b", ".", "*", "?", "[ab]", "[!a]", "[a-c]", "[]", "["]), max_size=6))
+    return "".join(parts)
+
+
+@given(patterns(), lists(text(alphabet="ab.c[]", max_size=8)))
+def test_glob(pattern: str, keys: list[str]) -> None:
+    glob = Glob(pattern)
+    for k in keys:
+        assert glob.match(k) == fnmatch.fnmatchcase(k, pattern), f"{pattern!r} on {k!r}"
+        if glob.match(k):
+            assert k.startswith(glob.prefix)
+
+
+@given(patterns(), lists(text(alphabet="ab.c[]", max_size=8), unique=True))
+def test_select_glob(pattern: str, keys: list[str]) -> None:
+    with tempfile.TemporaryDirectory() as d:
+        store = Store(d, WALEngine(d, fsync="never"))
+        for k in keys:
+            store.insert(k, {"k": k})
+
+        expected = sorted(k for k in keys if fnmatch.fnmatchcase(k, pattern))
+        assert [next(iter(obj)) for obj in store.select(pattern, glob=True)] == expected
+
+        # the budget counts tested keys, not matches
+        tested = sum(1 for k in keys if k.startswith(Glob(pattern).prefix))
+        try:
+            store.select(pattern, glob=True, budget=tested - 1)
+            assert tested == 0
+        except BudgetExceeded:
+            assert tested > 0
+        store.close()
+
+
+if __name__ == "__main__":
+    test_glob()
+    test_select_glob()
+    print("Done")
@@ -1,5 +1,5 @@
 from hypothesis import given, settings, Verbosity
-from kvstore.message import Insert, Get, Delete, Select, Message
+from kvstore.message import Insert, Get, Delete, Select, Query, MultiInsert, MultiGet, MultiDelete, Message
 from hypothesis.strategies import (
     composite,
     DrawFn,
@@ -9,6 +9,8 @@ from hypothesis.strategies import (
     none,
     booleans,
     dictionaries,
+    sampled_from,
+    lists,
 )
 
 import os
@@ -70,9 +72,36 @@ def selects(draw: DrawFn) -> Select:
     return Select(k=k)
 
 
+@composite
+def globs(draw: DrawFn) -> Select:
+    select = draw(selects())
+    return Select(k=select.k, opts={"glob": True})
+
+
+@composite
+def queries(draw: DrawFn) -> Query:
+    field = draw(text(alphabet=string.ascii_letters + ".", min_size=1))
+    ops = draw(dictionaries(sampled_from(["eq", "gt", "gte", "lt", "lte"]), json(depth=0)))
+    return Query(field=field, where=ops)
+
+
+@composite
+def batches(draw: DrawFn) -> MultiInsert | MultiGet | MultiDelete:
+    ms = draw(lists(inserts(), max_size=10))
+    cls = draw(sampled_from([MultiGet, MultiDelete]))
+    return draw(sampled_from([MultiInsert(kvs=[(m.k, m.v) for m in ms]), cls(ks=[m.k for m in ms])]))
+
+
+@composite
+def conditionals(draw: DrawFn) -> Insert | Get | Delete:
+    m = draw(one_of(inserts(), gets(), deletes()))
+    m.if_version = draw(integers(min_value=0))
+    return m
+
+
 @composite
 def messages(draw: DrawFn) -> Message:
-    return draw(one_of(inserts(), gets(), deletes(), selects()))
+    return draw(one_of(inserts(), gets(), deletes(), selects(), globs(), queries(), batches(), conditionals()))
 
 
 @given(messages())
@@ -0,0 +1,84 @@
+from hypothesis import given
+from hypothesis.strategies import (
+    one_of,
+    none,
+    booleans,
+    floats,
+    tuples,
+    fixed_dictionaries,
+    lists,
+    text,
+    integers,
+    dictionaries,
+    sampled_from,
+    recursive,
+)
+
+from kvstore.store import Store, project
+from kvstore.wal import WALEngine
+
+import copy
+import re
+import tempfile
+
+
+def resolve(v: object, path: list[str]) -> tuple[bool, object]:
+    for part in path:
+        if not isinstance(v, dict) or part not in v:
+            return False, None
+        v = v[part]
+    return True, v
+
+
+# small key alphabet so the fields actually hit something
+values = recursive(integers(), lambda v: dictionaries(sampled_from("ab"), v, max_size=2))
+
+
+@given(values, lists(text(alphabet="ab.", min_size=1, max_size=5), max_size=5))
+def test_project(v: object, fields: list[str]) -> None:
+    original = copy.deepcopy(v)
+    result = project(v, fields)
+    assert v == original, "projection modified the stored value"
+
+    for field in fields:
+        found, value = resolve(v, field.split("."))
+        assert resolve(result, field.split(".")) == (found, value)
+
+
+scalars = one_of(none(), booleans(), integers(-5, 5), floats(-5, 5), sampled_from(["x", "y"]))
+records = fixed_dictionaries({}, optional={"n": scalars, "g": one_of(scalars, values)})
+
+
+@given(
+    lists(tuples(sampled_from(["a1", "a2", "a3", "b1", "b2"]), records), max_size=20),
+    sampled_from(["a.*", ".*", "b", ".*2"]),
+    sampled_from(["hash", "ordered", None]),
+)
+def test_aggregate(items: list[tuple[str, dict]], pattern: str, kind: str | None) -> None:
+    with tempfile.TemporaryDirectory() as d:
+        store = Store(d, WALEngine(d, fsync="never"))
+        for k, v in items:
+            store.insert(k, v)
+        plain = store.aggregate(pattern, "n"), store.aggregate(pattern, "n", "g")
+
+        # reading the fields out of indexes must not change the answer
+        if kind is not None:
+            store.create_index("n", kind)
+            store.create_index("g", kind)
+            assert (store.aggregate(pattern, "n"), store.aggregate(pattern, "n", "g")) == plain
+
+        matched = [v for k, v in dict(items).items() if re.match(pattern, k)]
+        numbers = [v["n"] for v in matched if type(v.get("n")) in (int, float)]
+        result, grouped = plain
+        assert result["count"] == len(matched)
+        assert result.get("values", 0) == len(numbers)
+        if numbers:
+            assert result["min"] == min(numbers) and result["max"] == max(numbers)
+        assert sum(g["count"] for g in grouped["groups"]) == len(matched)
+        store.close()
+
+
+if __name__ == "__main__":
+    test_project()
+    test_aggregate()
+    print("Done")
@@ -0,0 +1,37 @@
+from hypothesis import given, settings
+from hypothesis.strategies import sampled_from, booleans
+
+from kvstore.server import parse_args, open_store
+
+import tempfile
+import datetime
+
+
+# Lazy loading needs an engine that reads single values, the others are
+# refused before anything is opened.
+@given(sampled_from(["files", "wal", "bitcask"]), booleans(), booleans())
+@settings(deadline=datetime.timedelta(milliseconds=5000), max_examples=20)
+def test_lazy_engines(engine: str, lazy: bool, bounded: bool) -> None:
+    with tempfile.TemporaryDirectory() as d:
+        argv = ["--dir", d, "--engine", engine, "--fsync", "never"]
+        argv += ["--lazy"] if lazy else []
+        argv += ["--max-memory", "64"] if bounded else []
+        if engine == "wal" and (lazy or bounded):
+            try:
+                parse_args(argv)
+                assert False, "lazy loading was accepted with the wal engine"
+            except SystemExit:
+                return
+
+        store = open_store(parse_args(argv), d)
+        store.insert("k", {"v": 1})
+        store.save()
+        store.close()
+        store = open_store(parse_args(argv), d)
+        assert store.get("k") == {"v": 1}
+        store.close()
+
+
+if __name__ == "__main__":
+    test_lazy_engines()
+    print("Done")
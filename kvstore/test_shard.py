@@ -0,0 +1,136 @@
+from hypothesis import given, settings
+from hypothesis.strategies import composite, integers, lists, sampled_from
+
+from kvstore.store import Store, StoreServer, StoreHandler
+from kvstore.shard import PeerServer, ShardServer, launch, owner
+from kvstore.client import Client
+from kvstore.wal import WALEngine
+from kvstore.message import Insert, Get, Delete, MultiInsert, MultiGet, Select, Count, Aggregate, Shutdown, Message
+
+from threading import Thread
+import tempfile
+import datetime
+import json
+import multiprocessing
+import socket
+import time
+
+
+@composite
+def messages(draw):
+    k = draw(sampled_from("abcdefgh"))
+    match draw(sampled_from(["insert", "get", "delete", "insertmany", "getmany", "select", "count", "aggregate"])):
+        case "insert":
+            return Insert(k=k, v={"n": draw(integers(0, 9)), "g": draw(sampled_from("xy"))})
+        case "get":
+            return Get(k=k)
+        case "delete":
+            return Delete(k=k)
+        case "insertmany":
+            return MultiInsert(kvs=[[k, {"n": draw(integers(0, 9))}] for k in draw(lists(sampled_from("abcdefgh")))])
+        case "getmany":
+            return MultiGet(ks=draw(lists(sampled_from("abcdefgh"))))
+        case "select":
+            opts = draw(sampled_from([{}, {"keys": True}, {"count": True}, {"limit": 2}, {"fields": ["n"]}]))
+            return Select(k=".*", opts=opts)
+        case "count":
+            return Count(k=".*")
+        case "aggregate":
+            return Aggregate(k=".*", field="n", by=draw(sampled_from([None, "g"])))
+
+
+def cluster(d: str, shards: int) -> list:
+    stores = [Store(f"{d}/shard-{i}", WALEngine(f"{d}/shard-{i}", fsync="never")) for i in range(shards)]
+    peers = [PeerServer(("localhost", 0), StoreHandler, store, workers=4 * shards) for store in stores]
+    addresses = [peer.server_address for peer in peers]
+    publics = []
+    for i, peer in enumerate(peers):
+        # the first one picks the port, the others share it
+        address = ("localhost", publics[0].server_address[1] if publics else 0)
+        publics.append(ShardServer(address, StoreHandler, peer, i, addresses, workers=2))
+    for server in peers + publics:
+        Thread(target=server.serve_forever, daemon=True).start()
+    return peers + publics
+
+
+# A sharded cluster answers like a single store, whichever shard a client
+# lands on, and a paged select walks the same pages.
+@given(lists(messages(), max_size=30), integers(min_value=2, max_value=4))
+@settings(deadline=datetime.timedelta(milliseconds=10000), max_examples=20)
+def test_sharded(msgs: list, shards: int) -> None:
+    answers = []
+    with tempfile.TemporaryDirectory() as d:
+        servers = cluster(d, shards)
+        single = StoreServer(("localhost", 0), StoreHandler, Store(d, WALEngine(d, fsync="never")))
+        Thread(target=single.serve_forever, daemon=True).start()
+
+        for server in (single, servers[-1]):
+            c = Client(*server.server_address, prefix="p")
+            # the client prefixes keys in place, so each run gets fresh copies
+            answers.append([c.request(Message.deserialize(msg.serialize())) for msg in msgs])
+            pages = []
+            cursor = None
+            while cursor != "":
+                page = c.request(Select(k=".*", opts={"limit": 3} | ({"cursor": cursor} if cursor else {})))
+                pages.append(page)
+                cursor = json.loads(page)["cursor"] or ""
+            answers.append(pages)
+            c.close()
+
+        for server in servers + [single]:
+            server.shutdown()
+            server.server_close()
+        # a shard's peer and public servers share its store
+        for store in {server.store for server in servers + [single]}:
+            store.close()
+
+    one, one_pages, sharded, sharded_pages = answers
+    assert sharded == one
+    assert sharded_pages == one_pages
+
+
+def open_store(directory: str) -> Store:
+    return Store(directory, WALEngine(directory, fsync="never"))
+
+
+# A Shutdown stops every shard process, however many there are, and each
+# one closes its store before it ends. With the default eight workers a
+# shard's peer server has more of them than its queue holds.
+@given(lists(sampled_from("abcdefgh"), max_size=10), integers(min_value=5, max_value=6))
+@settings(deadline=datetime.timedelta(milliseconds=30000), max_examples=3)
+def test_shutdown(keys: list, shards: int) -> None:
+    with tempfile.TemporaryDirectory() as d:
+        with socket.socket() as s:
+            s.bind(("localhost", 0))
+            port = s.getsockname()[1]
+        # forked from a thread, a shard could inherit a lock held by this one
+        launcher = multiprocessing.get_context("fork").Process(
+            target=launch, args=(d, shards, ("localhost", port), open_store)
+        )
+        launcher.start()
+
+        for _ in range(100):
+            try:
+                c = Client("localhost", port, prefix="p")
+                c.request(Count(k=".*"))
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.1)
+        for k in keys:
+            c.request(Insert(k=k, v={"n": 1}))
+        assert c.request(Shutdown()) == "SERVER SHUTDOWN"
+        c.close()
+        launcher.join(20)
+        assert launcher.exitcode == 0
+
+        for shard in range(shards):
+            store = open_store(f"{d}/shard-{shard}")
+            owned = {f"p_{k}" for k in keys if owner(f"p_{k}", shards) == shard}
+            assert store.count(".*") == len(owned)
+            assert all(store.get(k) == {"n": 1} for k in owned)
+            store.close()
+
+if __name__ == "__main__":
+    test_sharded()
+    test_shutdown()
+    print("Done")
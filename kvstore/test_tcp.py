@@ -0,0 +1,108 @@
+from hypothesis import given, settings
+from hypothesis.strategies import composite, integers, lists, sampled_from
+
+from kvstore.store import Store
+from kvstore.tcp import TCPStoreServer
+from kvstore.client import TCPClient
+from kvstore.wal import WALEngine
+from kvstore.message import Insert, Get, Delete, Startup, Stop, Shutdown
+
+from threading import Thread
+import tempfile
+import datetime
+
+
+@composite
+def requests(draw):
+    match draw(sampled_from(["insert", "get", "delete", "stop", "startup"])):
+        case "insert":
+            return Insert(k=draw(sampled_from("abc")), v=draw(integers(0, 9)))
+        case "get":
+            return Get(k=draw(sampled_from("abc")))
+        case "delete":
+            return Delete(k=draw(sampled_from("abc")))
+        case "stop":
+            return Stop()
+        case "startup":
+            return Startup()
+
+
+def serve(d: str) -> tuple[TCPStoreServer, Thread]:
+    server = TCPStoreServer(("localhost", 0), Store(d, WALEngine(d, fsync="never")))
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.ready.wait()
+    return server, thread
+
+
+# Answers to a pipelined batch match the answers a model gives one by one.
+@given(lists(requests(), max_size=30))
+@settings(deadline=datetime.timedelta(milliseconds=5000), max_examples=50)
+def test_pipeline(msgs: list) -> None:
+    with tempfile.TemporaryDirectory() as d:
+        server, _ = serve(d)
+        c = TCPClient(*server.server_address, prefix="p")
+
+        model = {}
+        running = True
+        expected = []
+        for msg in msgs:
+            match msg:
+                case Startup():
+                    running = True
+                    expected.append("SERVER STARTED")
+                case _ if not running:
+                    expected.append("SERVER IS NOT RUNNING")
+                case Stop():
+                    running = False
+                    expected.append("SERVER STOPPED")
+                case Insert(k, v):
+                    old = model.get(k)
+                    model[k] = v
+                    expected.append("OK" if old is None else str(old))
+                case Get(k):
+                    expected.append(str(model[k]) if k in model else "NOT FOUND")
+                case Delete(k):
+                    expected.append(str(model.pop(k)) if k in model else "NOT FOUND")
+
+        assert c.pipeline(msgs) == expected
+        c.close()
+        server.shutdown()
+
+
+# Several connections share the loop, and Shutdown stops a running server.
+@given(integers(min_value=1, max_value=8), integers(min_value=1, max_value=20))
+@settings(deadline=datetime.timedelta(milliseconds=10000), max_examples=10)
+def test_connections(clients: int, n: int) -> None:
+    with tempfile.TemporaryDirectory() as d:
+        server, serving = serve(d)
+        cs = [TCPClient(*server.server_address, prefix=f"c{i}") for i in range(clients)]
+
+        def insert(c: TCPClient) -> None:
+            for i in range(n):
+                c.request(Insert(k=str(i), v=i))
+
+        threads = [Thread(target=insert, args=(c,)) for c in cs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # a stopped server refuses Shutdown like anything else
+        assert cs[0].request(Stop()) == "SERVER STOPPED"
+        assert cs[0].request(Shutdown()) == "SERVER IS NOT RUNNING"
+        assert cs[-1].request(Startup()) == "SERVER STARTED"
+        assert cs[0].request(Shutdown()) == "SERVER SHUTDOWN"
+        for c in cs:
+            c.close()
+        serving.join()
+
+        store = Store(d, WALEngine(d))
+        assert len(store.select(".*")) == clients * n
+        store.close()
+
+
+if __name__ == "__main__":
+    test_pipeline()
+    test_connections()
+    print("Done")
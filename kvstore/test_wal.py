@@ -0,0 +1,217 @@
+from hypothesis import given, settings
+from hypothesis.strategies import (
+    composite,
+    DrawFn,
+    one_of,
+    lists,
+    binary,
+    booleans,
+    sampled_from,
+    integers,
+)
+
+from kvstore.store import Store, Conflict
+from kvstore.wal import WALEngine
+from kvstore.message import Insert, Delete
+from kvstore.test_message import inserts, deletes
+
+import os
+import re
+import string
+import tempfile
+import datetime
+from unittest.mock import patch
+
+
+@composite
+def mutations(draw: DrawFn) -> list[Insert | Delete]:
+    return draw(lists(one_of(inserts(), deletes()), max_size=50))
+
+
+def contents(store: Store) -> dict:
+    return {k: v for obj in store.select(".*") for k, v in obj.items()}
+
+
+# Applies the mutations in order, checking what the store answers, and
+# returns what it should hold. Saves after each one unless told not to,
+# `step(i, st)` runs after each for whatever a test checks on the way.
+def apply(store: Store, ms: list[Insert | Delete], save: bool = True, step=None) -> dict:
+    st = {}
+    for i, m in enumerate(ms):
+        match m:
+            case Insert(k, v):
+                assert store.insert(k, v) == st.get(k)
+                st[k] = v
+            case Delete(k):
+                assert store.delete(k) == st.get(k)
+                if st.get(k) is not None:
+                    del st[k]
+        if save:
+            store.save()
+        if step is not None:
+            step(i, st)
+    return st
+
+
+@given(mutations(), lists(booleans()), binary(max_size=16))
+@settings(deadline=datetime.timedelta(milliseconds=5000))
+def test_replay(ms: list[Insert | Delete], snapshots: list[bool], garbage: bytes) -> None:
+    with tempfile.TemporaryDirectory() as d:
+        store = Store(d, WALEngine(d, fsync="never", retain=1))
+        st = apply(store, ms, step=lambda i, st: i < len(snapshots) and snapshots[i] and store.snapshot())
+        store.close()
+
+        # a torn tail must not hide any of the records before it
+        log = max(f for f in os.listdir(d) if f.endswith(".log"))
+        with open(f"{d}/{log}", "ab") as f:
+            f.write(garbage)
+
+        store = Store(d, WALEngine(d))
+        assert contents(store) == st
+        store.close()
+
+
+@given(mutations(), sampled_from(string.printable), booleans())
+@settings(deadline=datetime.timedelta(milliseconds=5000))
+def test_delete_range(ms: list[Insert | Delete], prefix: str, torn: bool) -> None:
+    with tempfile.TemporaryDirectory() as d:
+        engine = WALEngine(d, fsync="never")
+        store = Store(d, engine)
+        apply(store, ms, save=False)
+        store.save()
+        before = contents(store)
+        records = engine.stats()["records"]
+
+        deleted = store.delete_range(re.escape(prefix))
+        store.save()
+        after = {k: v for k, v in before.items() if not k.startswith(prefix)}
+        assert deleted == len(before) - len(after)
+        assert contents(store) == after
+        assert engine.stats()["records"] == records + (1 if deleted else 0)
+        store.close()
+
+        # cutting into the range delete's record must lose all of it
+        if torn and deleted:
+            log = max(f for f in os.listdir(d) if f.endswith(".log"))
+            os.truncate(f"{d}/{log}", os.path.getsize(f"{d}/{log}") - 1)
+        store = Store(d, WALEngine(d))
+        assert contents(store) == (before if torn and deleted else after)
+        store.close()
+
+
+@given(mutations(), mutations(), lists(sampled_from(["value", "exists", "missing"]), max_size=3), booleans())
+@settings(deadline=datetime.timedelta(milliseconds=5000))
+def test_transaction(setup: list[Insert | Delete], ms: list[Insert | Delete], kinds: list[str], stale: bool) -> None:
+    with tempfile.TemporaryDirectory() as d:
+        engine = WALEngine(d, fsync="never")
+        store = Store(d, engine)
+        apply(store, setup, save=False)
+        before = contents(store)
+        records = engine.stats()["records"]
+
+        # checks built from the current state hold, a stale one never does
+        keys = [m.k for m in setup + ms] or ["k"]
+        checks = []
+        for i, kind in enumerate(kinds):
+            k = keys[i % len(keys)]
+            match kind:
+                case "value" if k in before:
+                    checks.append({"key": k, "value": before[k]})
+                case "exists" | "value":
+                    checks.append({"key": k, "exists": k in before})
+                case "missing":
+                    checks.append({"key": k + "\0", "exists": False})
+        if stale:
+            checks.append({"key": keys[0], "exists": keys[0] not in before})
+
+        ops = [["insert", m.k, m.v] if isinstance(m, Insert) else ["delete", m.k] for m in ms]
+        after = dict(before)
+        for op in ops:
+            if op[0] == "insert":
+                after[op[1]] = op[2]
+            else:
+                after.pop(op[1], None)
+        try:
+            store.transact(ops, checks)
+            assert not stale
+        except Conflict as e:
+            assert stale and e.key == keys[0]
+            after = before
+        store.save()
+        assert contents(store) == after
+        assert engine.stats()["records"] - records <= 1
+        store.close()
+
+        store = Store(d, WALEngine(d))
+        assert contents(store) == after
+        store.close()
+
+
+@given(mutations())
+@settings(deadline=datetime.timedelta(milliseconds=5000))
+def test_versions(ms: list[Insert | Delete]) -> None:
+    with tempfile.TemporaryDirectory() as d:
+        store = Store(d, WALEngine(d, fsync="never"))
+        seen = 0
+        for m in ms:
+            version = store.version(m.k)
+            match m:
+                case Insert(k, v):
+                    # a write at a stale version is refused and changes nothing
+                    try:
+                        store.insert(k, "stale", if_version=(version or 0) + 1)
+                        assert False, "insert at a stale version succeeded"
+                    except Conflict as e:
+                        assert store.version(k) == version
+                        assert e.version == (version or 0)
+                    _, written = store.insert_versioned(k, v, if_version=version or 0)
+                    assert written == store.version(k)
+                    assert written > max(seen, version or 0)
+                    seen = written
+                case Delete(k):
+                    try:
+                        store.delete(k, if_version=(version or 0) + 1)
+                        assert False, "delete at a stale version succeeded"
+                    except Conflict as e:
+                        assert e.version == (version or 0)
+                    store.delete(k, if_version=version or 0)
+        store.close()
+
+        # versions from before a restart never match again
+        store = Store(d, WALEngine(d))
+        for m in ms:
+            assert store.version(m.k) is None or store.version(m.k) > seen
+        store.close()
+
+
+
+# A wall clock that stepped back across a restart must not hand out old
+# versions again, or a stale `if_version` would match a newer value.
+@given(integers(min_value=1, max_value=20), integers(min_value=0, max_value=1 << 40))
+@settings(deadline=datetime.timedelta(milliseconds=5000), max_examples=20)
+def test_clock_steps_back(n: int, now: int) -> None:
+    with tempfile.TemporaryDirectory() as d:
+        store = Store(d, WALEngine(d, fsync="never"))
+        versions = [store.insert_versioned("k", i)[1] for i in range(n)]
+        store.close()
+
+        with patch("time.time_ns", return_value=now * 1000):
+            store = Store(d, WALEngine(d))
+            _, version = store.insert_versioned("k", "after")
+            assert version > max(versions)
+            for stale in versions:
+                try:
+                    store.insert("k", "stale", if_version=stale)
+                    assert False, "a version from before the restart matched"
+                except Conflict:
+                    pass
+            store.close()
+
+
+if __name__ == "__main__":
+    test_replay()
+    test_delete_range()
+    test_transaction()
+    test_versions()
+    test_clock_steps_back()
+    print("Done")
@@ -0,0 +1,244 @@
+from typing import Literal
+from threading import Thread, Lock
+from engine import Engine
+from codec import Codec
+import os
+import struct
+import time
+import zlib
+
+type fsync_policy = Literal["always", "interval", "never"]
+
+# Every record is framed as <length><crc32><payload>, so a torn or corrupted
+# tail left behind by a crash is detected on replay and cut off.
+HEADER = struct.Struct("<II")
+
+
+def records(data: bytes, codec: Codec):
+    offset = 0
+    while offset + HEADER.size <= len(data):
+        length, crc = HEADER.unpack_from(data, offset)
+        start = offset + HEADER.size
+        payload = data[start : start + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            return
+        try:
+            op = codec.decode(payload)
+        except (ValueError, IndexError):
+            return
+        offset = start + length
+        yield op, offset
+
+
+def frame(op: list, codec: Codec) -> bytes:
+    payload = codec.encode(op)
+    return HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def apply(items: dict, op: list) -> None:
+    match op:
+        case ["insert", k, v]:
+            items[k] = v
+        case ["delete", k]:
+            items.pop(k, None)
+        case ["batch", ops]:
+            for op in ops:
+                apply(items, op)
+        case _:
+            raise ValueError(f"Unsupported record: {op}")
+
+
+# The log is split into numbered segments `{seq}.log`. A snapshot `{seq}.snap`
+# holds the state as of the start of log `seq`, so recovery loads the newest
+# valid snapshot and only replays the logs from `seq` on.
+class WALEngine(Engine):
+    def __init__(
+        self,
+        name: str,
+        fsync: fsync_policy = "always",
+        fsync_interval: float = 1.0,
+        snapshot_interval: float | None = None,
+        retain: int = 2,
+        codec: Codec | None = None,
+    ) -> None:
+        if fsync not in ("always", "interval", "never"):
+            raise ValueError(f"Unsupported fsync policy: {fsync}")
+        self.name = name
+        self.codec = codec if codec is not None else Codec()
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.snapshot_interval = snapshot_interval
+        self.retain = max(retain, 1)
+        self.last_sync = time.monotonic()
+        self.last_snapshot = time.monotonic()
+        self.lock = Lock()
+        self.snapshot_lock = Lock()
+        self.seq = 0
+        self.file = None
+        self.records = 0
+        self.bytes = 0
+        self.fsyncs = 0
+        self.snapshots = 0
+        self.snapshot_ms = 0.0
+        os.makedirs(self.name, exist_ok=True)
+
+    def path(self, seq: int, ext: str) -> str:
+        return f"{self.name}/{seq:08d}.{ext}"
+
+    def files(self, ext: str) -> list[int]:
+        return sorted(
+            int(f[: -len(ext) - 1]) for f in os.listdir(self.name) if f.endswith(f".{ext}")
+        )
+
+    def read_snapshot(self, seq: int) -> dict | None:
+        with open(self.path(seq, "snap"), "rb") as f:
+            data = f.read()
+        items = {}
+        for op, _ in records(data, self.codec):
+            match op:
+                case ["end", n]:
+                    return items if len(items) == n else None
+                case _:
+                    apply(items, op)
+        return None
+
+    def load(self) -> dict:
+        self.close()
+        for f in os.listdir(self.name):
+            if f.endswith(".tmp"):
+                os.remove(f"{self.name}/{f}")
+
+        items = {}
+        start = 0
+        for seq in reversed(self.files("snap")):
+            snapshot = self.read_snapshot(seq)
+            if snapshot is not None:
+                items, start = snapshot, seq
+                break
+
+        logs = [seq for seq in self.files("log") if seq >= start]
+        for seq in logs:
+            with open(self.path(seq, "log"), "rb") as f:
+                data = f.read()
+            end = 0
+            for op, end in records(data, self.codec):
+                apply(items, op)
+            if end < len(data):
+                os.truncate(self.path(seq, "log"), end)
+
+        self.seq = logs[-1] if logs else start
+        self.file = open(self.path(self.seq, "log"), "ab")
+        return items
+
+    def append(self, op: list) -> None:
+        record = frame(op, self.codec)
+        with self.lock:
+            self.file.write(record)
+            self.records += 1
+            self.bytes += len(record)
+
+    def insert(self, k: str, v: dict) -> None:
+        self.append(["insert", k, v])
+
+    def delete(self, k: str) -> None:
+        self.append(["delete", k])
+
+    # one record for the whole batch, so a torn write drops all of it
+    def batch(self, ops: list[list]) -> None:
+        self.append(["batch", ops])
+
+    def save(self, items: dict) -> None:
+        with self.lock:
+            self.file.flush()
+            match self.fsync:
+                case "always":
+                    os.fsync(self.file.fileno())
+                    self.fsyncs += 1
+                case "interval":
+                    now = time.monotonic()
+                    if now - self.last_sync >= self.fsync_interval:
+                        os.fsync(self.file.fileno())
+                        self.fsyncs += 1
+                        self.last_sync = now
+                case "never":
+                    pass
+
+        if (
+            self.snapshot_interval is not None
+            and time.monotonic() - self.last_snapshot >= self.snapshot_interval
+        ):
+            self.snapshot(items, wait=False)
+
+    def snapshot(self, items: dict, wait: bool = True) -> None:
+        # a periodic snapshot is skipped while the previous one is running,
+        # a forced one waits for it
+        if not self.snapshot_lock.acquire(blocking=wait):
+            return
+        self.last_snapshot = time.monotonic()
+
+        # Writers only wait for the log switch and a shallow copy, since
+        # values are replaced on update rather than mutated. The copy is
+        # taken after the switch and outside our lock, as it waits for the
+        # store's writers, which hold their lock while they log. Items ahead
+        # of the old log are harmless, replaying those records again on top
+        # of the snapshot gives the same result.
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.seq += 1
+            self.file = open(self.path(self.seq, "log"), "ab")
+            seq = self.seq
+        items = items.copy()
+
+        thread = Thread(target=self.write_snapshot, args=(seq, items), daemon=True)
+        thread.start()
+        if wait:
+            thread.join()
+
+    def write_snapshot(self, seq: int, items: dict) -> None:
+        try:
+            start = time.perf_counter()
+            tmp = self.path(seq, "snap") + ".tmp"
+            with open(tmp, "wb") as f:
+                for k, v in items.items():
+                    f.write(frame(["insert", k, v], self.codec))
+                f.write(frame(["end", len(items)], self.codec))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path(seq, "snap"))
+
+            # keep `retain` snapshots and the logs needed to replay the oldest
+            snapshots = self.files("snap")
+            for old in snapshots[: -self.retain]:
+                os.remove(self.path(old, "snap"))
+            oldest = snapshots[-self.retain :][0]
+            for old in self.files("log"):
+                if old < oldest:
+                    os.remove(self.path(old, "log"))
+
+            self.snapshots += 1
+            self.snapshot_ms = 1000 * (time.perf_counter() - start)
+        finally:
+            self.snapshot_lock.release()
+
+    def stats(self) -> dict:
+        return {
+            "records": self.records,
+            "bytes": self.bytes,
+            "fsyncs": self.fsyncs,
+            "log": self.seq,
+            "snapshots": self.snapshots,
+            "last_snapshot_ms": self.snapshot_ms,
+            "codec": self.codec.stats(),
+        }
+
+    def close(self) -> None:
+        # let a running snapshot finish before the files go away
+        with self.snapshot_lock:
+            pass
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None